@@ -0,0 +1,214 @@
+"""
+Benchmark of alias matching on synthetic guilds.
+Messages are replayed through the alias cog with stand-in bot and message
+objects, so neither Discord nor a database is needed.
+Guild time budget is disabled to measure matching rather than throttling.
+
+Usage: python -m benchmarks.aliases [--sizes 20 200 2000] [--messages 2000]
+"""
+
+import time
+import random
+import asyncio
+import argparse
+import logging as log
+from types import SimpleNamespace
+from collections import Counter
+from statistics import quantiles
+
+from commands.alias import Aliases
+from modules.prima import DEFAULT_CONFIG
+from modules.router import MessageRouter
+from modules.settings import GuildSettings
+
+WORDS = (
+    "hug pat poke slap wave greet roll flip quote rate ship kiss bonk yeet boop "
+    "cheer clap cry dance facepalm laugh nod pout shrug sleep smile stare think"
+).split()
+CHAT = (
+    "hello everyone",
+    "did anyone see the game yesterday?",
+    "lol that's so true",
+    "brb getting food",
+    "can someone help me with my homework",
+    "gg wp",
+    "what time is the event tomorrow",
+    "i think the new update broke something",
+)
+# pattern, command, message that triggers it; {w} is a unique word
+TEMPLATES = (
+    ("{w}", "say {w}!", "{w}"),
+    ("{w} $target", "say {user.mention} {w}s $target", "{w} @someone"),
+    ("{w} $*", "say $*", "{w} some longer text here"),
+    ("{w} $a $b", "say $b $a\nsay done", '{w} first "second one"'),
+    ("(hey|hi) {w}", "say hello", "hey {w}"),
+    (r"{w}\d+", "say number", "{w}42"),
+    (".*{w}.*", "say heard {w}", "i said {w} somewhere"),
+)
+# nested alternations backtrack exponentially when the input doesn't end right
+ADVERSARIAL = (("ha", "!"), ("o", "ps"), ("lo", "l"))
+
+
+def word(i: int) -> str:
+    return f"{WORDS[i % len(WORDS)]}{i // len(WORDS) or ''}"
+
+
+def make_aliases(size: int, rng: random.Random) -> tuple[dict[str, str], list[str]]:
+    "Returns aliases and messages that trigger them"
+    aliases = {}
+    triggers = []
+    for i in range(size):
+        pattern, command, trigger = rng.choice(TEMPLATES)
+        w = word(i)
+        aliases[pattern.format(w=w)] = command.replace("{w}", w)
+        triggers.append(trigger.format(w=w))
+    return aliases, triggers
+
+
+def make_adversarial(size: int) -> tuple[dict[str, str], list[str]]:
+    aliases = {}
+    messages = []
+    for pump, end in ADVERSARIAL[: max(1, size // 100)]:
+        aliases[f"({pump}|{pump * 2})+{end}"] = "say never"
+        messages.append(pump * 40)
+    return aliases, messages
+
+
+def make_stream(
+    triggers: list[str],
+    adversarial: list[str],
+    count: int,
+    adversarial_rate: float,
+    rng: random.Random,
+) -> list[str]:
+    stream = []
+    for _ in range(count):
+        roll = rng.random()
+        if roll < adversarial_rate:
+            stream.append(rng.choice(adversarial))
+        elif roll < 0.4:
+            stream.append(rng.choice(triggers))
+        else:
+            stream.append(rng.choice(CHAT))
+    return stream
+
+
+class StandInBot:
+    "Has just enough of PrimaBot for the alias cog"
+
+    test_mode = False
+    test_channel_id = None
+
+    def __init__(self, config: dict, settings: GuildSettings):
+        self.config = config
+        self.settings = settings
+        self.loop = asyncio.get_running_loop()
+        self.message_stats = Counter()
+        self.router = MessageRouter()
+        self.guild_settings = SimpleNamespace(load_listeners=[], items=lambda: ())
+        self.invoked = 0
+
+    async def get_guild_settings(self, guild) -> GuildSettings:
+        return self.settings
+
+    async def get_prefixes(self, guild) -> list[str]:
+        return self.config["prefix"]
+
+    async def get_language(self, guild) -> str:
+        return "en"
+
+    def build_context(self, message, prefix: str, invoker: str, language: str):
+        return message
+
+    async def invoke(self, ctx):
+        self.invoked += 1
+
+
+def make_message(content: str) -> SimpleNamespace:
+    async def send(*args, **kwargs):
+        pass
+
+    author = SimpleNamespace(id=1, bot=False, mention="<@1>", name="user")
+    return SimpleNamespace(
+        content=content,
+        author=author,
+        guild=SimpleNamespace(id=1),
+        channel=SimpleNamespace(id=1, send=send),
+    )
+
+
+async def run(size: int, args: argparse.Namespace) -> dict:
+    rng = random.Random(args.seed)
+    aliases, triggers = make_aliases(size, rng)
+    adversarial_aliases, adversarial = make_adversarial(size)
+    # adversarial aliases go last so that they don't hide others
+    settings = GuildSettings(aliases=aliases | adversarial_aliases)
+    start = time.perf_counter()
+    settings.alias_index()
+    build_time = time.perf_counter() - start
+
+    config = DEFAULT_CONFIG | {
+        "alias_message_budget": args.budget,
+        "alias_guild_budget": float("inf"),
+    }
+    bot = StandInBot(config, settings)
+    cog = Aliases(bot)
+    stream = make_stream(triggers, adversarial, args.messages, args.adversarial, rng)
+    latencies = []
+    try:
+        total_start = time.perf_counter()
+        for content in stream:
+            message = make_message(content)
+            start = time.perf_counter()
+            await cog.handle_message(message)
+            latencies.append(time.perf_counter() - start)
+        total = time.perf_counter() - total_start
+    finally:
+        cog.cog_unload()
+
+    percentiles = quantiles(latencies, n=100)
+    return {
+        "aliases": len(settings.aliases),
+        "build ms": build_time * 1000,
+        "msg/s": len(stream) / total,
+        "matches/s": bot.message_stats["alias"] / total,
+        "p50 ms": percentiles[49] * 1000,
+        "p99 ms": percentiles[98] * 1000,
+        "timeouts": bot.message_stats["alias_timeout"],
+        "invoked": bot.invoked,
+    }
+
+
+async def main(args: argparse.Namespace):
+    results = [await run(size, args) for size in args.sizes]
+    columns = list(results[0])
+    print(" ".join(f"{c:>10}" for c in columns))
+    for result in results:
+        print(
+            " ".join(
+                f"{v:>10.2f}" if isinstance(v, float) else f"{v:>10}"
+                for v in result.values()
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark alias matching")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20, 200, 2000])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument(
+        "--adversarial",
+        type=float,
+        default=0.005,
+        help="share of messages that make adversarial patterns backtrack",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=DEFAULT_CONFIG["alias_message_budget"],
+        help="time budget of one message in seconds",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    # timeouts are counted in the results
+    log.basicConfig(level=log.ERROR)
+    asyncio.run(main(parser.parse_args()))
@@ -1,25 +1,47 @@
 import copy
+import time
+import logging as log
+from typing import Callable, TypeVar
+from concurrent.futures import ThreadPoolExecutor
 
 import regex
 from discord import Message
 from discord.ext import commands
+from sqlalchemy.exc import IntegrityError
 
 from modules.i18n import t
 from modules.prima import ADD_ALIASES, REMOVE_ALIASES
-from modules.regexps import (
-    ARG,
-    VAR_ARG,
-    PING,
-    ARGUMENT_TEMPLATE,
-    SIDE_QUOTES,
-)
+from modules.aliases import CompiledAlias, TimeBudgets, match_candidates
+from modules.settings import GuildSettings
+from modules.regexps import ARG, VAR_ARG, PING
 
+T = TypeVar("T")
 
-class Aliases(commands.Cog):
-    MAX_ALIASES_PER_GUILD = 20
 
+class Aliases(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.executor = ThreadPoolExecutor(
+            bot.config["alias_workers"], thread_name_prefix="alias"
+        )
+        self.guild_budgets = TimeBudgets(
+            bot.config["alias_guild_budget"], bot.config["alias_guild_budget_period"]
+        )
+        bot.guild_settings.load_listeners.append(self.on_settings_load)
+        for guild_id, settings in bot.guild_settings.items():
+            self.on_settings_load(guild_id, settings)
+
+    def cog_unload(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.bot.guild_settings.load_listeners.remove(self.on_settings_load)
+        self.bot.router.remove(self.handle_message)
+
+    def on_settings_load(self, guild_id: int, settings: GuildSettings):
+        # only guilds with aliases need to see messages
+        if settings.aliases:
+            self.bot.router.subscribe(self.handle_message, guild_id=guild_id)
+        else:
+            self.bot.router.unsubscribe(self.handle_message, guild_id=guild_id)
 
     @commands.group(aliases=("aliases",), invoke_without_command=True)
     @commands.guild_only()
@@ -43,17 +65,19 @@ class Aliases(commands.Cog):
     @commands.has_permissions(manage_guild=True)
     async def add(self, ctx, pattern: str, command: str):
         "alias.add.help"
-        aliases = await ctx.bot.get_aliases(ctx.guild)
+        # cached aliases may be outdated or missing if the database is slow
+        aliases = (await ctx.bot.guild_settings.load(ctx.guild)).aliases or {}
         pattern = self.uniping(pattern.lower())
         if pattern in aliases:
             await ctx.send(t("alias.add.already_exists", ctx.language, alias=pattern))
             return
-        if len(aliases) >= self.MAX_ALIASES_PER_GUILD:
+        limit = ctx.bot.config["max_aliases_per_guild"]
+        if len(aliases) >= limit:
             await ctx.send(
                 t(
                     "alias.add.limit_reached",
                     ctx.language,
-                    limit=self.MAX_ALIASES_PER_GUILD,
+                    limit=limit,
                 )
             )
             return
@@ -66,81 +90,104 @@ class Aliases(commands.Cog):
             return
         if await self.format_message(ctx.message, command) is None:
             return
-        aliases[pattern] = command
-        await ctx.bot.guilds_data.upsert(
-            guild_id=str(ctx.guild.id),
-            aliases=aliases,
+        limit = ctx.bot.config["alias_max_match_time"]
+        cost = await ctx.bot.loop.run_in_executor(
+            self.executor, CompiledAlias(pattern, command).worst_case_time, limit
         )
-        await ctx.bot.get_aliases.delete(ctx.guild)
+        if cost > limit:
+            await ctx.send(t("alias.add.reject_slow", ctx.language))
+            return
+        try:
+            await ctx.bot.aliases_data.insert(
+                guild_id=ctx.guild.id,
+                pattern=pattern,
+                command=command,
+                created_at=time.time(),
+            )
+        except IntegrityError:
+            # added concurrently
+            await ctx.send(t("alias.add.already_exists", ctx.language, alias=pattern))
+            return
         await ctx.send(t("alias.add.added", ctx.language, alias=pattern))
 
     @alias.command(usage="alias.remove.usage", aliases=REMOVE_ALIASES)
     @commands.has_permissions(manage_guild=True)
     async def remove(self, ctx, pattern: str):
         "alias.remove.help"
-        aliases = await ctx.bot.get_aliases(ctx.guild)
+        # cached aliases may be outdated or missing if the database is slow
+        aliases = (await ctx.bot.guild_settings.load(ctx.guild)).aliases or {}
         pattern = self.uniping(pattern.lower())
-        try:
-            del aliases[pattern]
-        except KeyError:
+        if pattern not in aliases:
             await ctx.send(t("alias.remove.not_found", ctx.language))
             return
-        await ctx.bot.guilds_data.upsert(
-            guild_id=str(ctx.guild.id),
-            aliases=aliases,
-        )
-        await ctx.bot.get_aliases.delete(ctx.guild)
+        await ctx.bot.aliases_data.delete(guild_id=ctx.guild.id, pattern=pattern)
         await ctx.send(t("alias.remove.removed", ctx.language, alias=pattern))
 
-    @commands.Cog.listener()
-    async def on_message(self, message: Message):
+    async def handle_message(self, message: Message):
         if self.bot.test_mode != (message.channel.id == self.bot.test_channel_id):
             return
-        if not message.content:
+        # commands of bots are ignored anyway
+        if message.author.bot or not message.content or not message.guild:
             return
+        settings = await self.bot.get_guild_settings(message.guild)
+        if not settings.aliases:
+            return
+        self.bot.message_stats["alias_candidate"] += 1
 
-        for key, value in (await self.bot.get_aliases(message.guild)).items():
-            alias = self.fetch_alias(message.content, key, value)
-            if not alias:
-                continue
-            alias = await self.format_message(message, alias)
-            if not alias:
+        candidates = list(settings.alias_index().candidates(message.content))
+        if not candidates:
+            return
+        guild_id = message.guild.id
+        budget = min(
+            self.bot.config["alias_message_budget"],
+            self.guild_budgets.remaining(guild_id),
+        )
+        if budget <= 0:
+            self.bot.message_stats["alias_budget_exhausted"] += 1
+            return
+        matches, timed_out, spent = await self.bot.loop.run_in_executor(
+            self.executor, match_candidates, candidates, message.content, budget
+        )
+        self.guild_budgets.spend(guild_id, spent)
+        for alias in timed_out:
+            self.bot.message_stats["alias_timeout"] += 1
+            log.warning("Alias %r of guild %d timed out", alias.pattern, guild_id)
+
+        for alias, match in matches:
+            steps = await self.render_alias(message, alias, match)
+            if not steps:
                 continue
 
+            self.bot.message_stats["alias"] += 1
             prefix = (await self.bot.get_prefixes(message.guild))[0]
+            language = await self.bot.get_language(message.guild)
             message_copy = copy.copy(message)
-            for command in alias.split("\n"):
-                message_copy.content = prefix + command
-                await self.bot.process_commands(message_copy)
+            for invoker, arguments in steps:
+                message_copy.content = prefix + invoker + arguments
+                await self.bot.invoke(
+                    self.bot.build_context(message_copy, prefix, invoker, language)
+                )
 
     @staticmethod
     def uniping(text: str) -> str:
         "Support deprecated <@!id> ping"
         return PING.sub(lambda x: x.group().replace("!", "").replace("@", "@!?"), text)
 
-    @staticmethod
-    def fetch_alias(text: str, pattern: str, command: str) -> str | None:
-        pattern = ARG.sub(lambda g: ARGUMENT_TEMPLATE % g.group(1), pattern)
-        pattern = VAR_ARG.sub("(?P<_VAR_ARG>.+?)", pattern)
-        try:
-            match = regex.fullmatch(pattern, text, regex.I | regex.DOTALL, timeout=1)
-        except (regex.error, TimeoutError):
-            return  # silent exit (should be changed?)
-        if not match:
-            return None
-        match = match.groupdict()
-        command = VAR_ARG.sub(match.get("_VAR_ARG", "$*"), command)
-        command = ARG.sub(
-            lambda g: (
-                SIDE_QUOTES.sub("", match.get(g.group(1), g.group())).replace("\\", "")
-            ),
-            command,
+    async def format_message(self, message: Message, text: str) -> str | None:
+        return await self._safe_format(
+            message, text.format, message=message, user=message.author
         )
-        return command
 
-    async def format_message(self, message: Message, text: str) -> str | None:
+    async def render_alias(
+        self, message: Message, alias: CompiledAlias, match: regex.Match
+    ) -> list[tuple[str, str]] | None:
+        return await self._safe_format(message, alias.render, match, message)
+
+    async def _safe_format(
+        self, message: Message, format: Callable[..., T], *args, **kwargs
+    ) -> T | None:
         try:
-            return text.format(message=message, user=message.author)
+            return format(*args, **kwargs)
         except (KeyError, AttributeError) as e:
             language = await self.bot.get_language(message.guild)
             name = getattr(e, "name", e.args[0])
@@ -16,7 +16,7 @@ class AutoRole(commands.Cog):
         em = embed.Embed(ctx)
         role = await ctx.bot.get_guild_property(ctx.guild, "autorole")
         if role:
-            role = ctx.guild.get_role(int(role))
+            role = ctx.guild.get_role(role)
         em.add_field(
             name=t("autorole.current", ctx.language),
             value=role.mention if role else t("autorole.not_set", ctx.language),
@@ -34,8 +34,8 @@ class AutoRole(commands.Cog):
     async def set(self, ctx, role: ManageableRole):
         "autorole.set.help"
         await ctx.bot.guilds_data.upsert(
-            guild_id=str(ctx.guild.id),
-            autorole=str(role.id),
+            guild_id=ctx.guild.id,
+            autorole=role.id,
         )
         await ctx.send(t("autorole.set.set", ctx.language))
 
@@ -44,7 +44,7 @@ class AutoRole(commands.Cog):
     async def remove(self, ctx):
         "autorole.remove.help"
         await ctx.bot.guilds_data.upsert(
-            guild_id=str(ctx.guild.id),
+            guild_id=ctx.guild.id,
             autorole=None,
         )
         await ctx.send(t("autorole.remove.removed", ctx.language))
@@ -59,7 +59,7 @@ class AutoRole(commands.Cog):
         role = await self.bot.get_guild_property(guild, "autorole")
         if not role:
             return
-        role = guild.get_role(int(role))
+        role = guild.get_role(role)
         if role and role < guild.me.top_role:
             await member.add_roles(
                 role,
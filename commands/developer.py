@@ -6,7 +6,9 @@ from discord import Activity, ActivityType, Status
 from discord.ext import commands
 from discord.ext.pages import Paginator
 
+from modules import db
 from modules.utils import execute
+from modules.querystats import query_stats
 from modules.i18n import t
 
 
@@ -109,6 +111,29 @@ class DeveloperUtils(commands.Cog):
         elif last_author != ctx.me:
             await ctx.send(t("exec.completed_without_output", ctx.language))
 
+    @commands.command(hidden=True)
+    async def stats(self, ctx):
+        lines = (
+            [f"{path}: {count}" for path, count in ctx.bot.message_stats.most_common()]
+            + [
+                f"{table.name} {stat}: {count}"
+                for table in db.tables.values()
+                for stat, count in table.read_stats.items()
+            ]
+            + db.describe_pool(ctx.bot.sql.pool)
+            + (
+                db.describe_pool(ctx.bot.read_sql.pool, "read pool")
+                if ctx.bot.read_sql is not ctx.bot.sql
+                else []
+            )
+            + query_stats.describe()
+        )
+        pages = [OUTPUT_FORMAT.format(p) for p in _paginate("\n".join(lines))]
+        if len(pages) == 1:
+            await ctx.send(pages[0])
+        else:
+            await Paginator(pages).send(ctx)
+
     @commands.command(hidden=True)
     async def status(
         self,
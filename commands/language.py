@@ -19,10 +19,9 @@ async def language(ctx, lang: str | None = None):
             )
         )
     await ctx.bot.guilds_data.upsert(
-        guild_id=str(ctx.guild.id),
+        guild_id=ctx.guild.id,
         language=lang,
     )
-    await ctx.bot.get_language.delete(ctx.guild)
     await ctx.send(t("language.switched", lang))
 
 
@@ -19,23 +19,21 @@ async def add(ctx, *, prefix_arg: str):
     if len(prefix_arg) > MAX_PREFIX_LEN:
         await ctx.send(t("prefix.add.too_long", ctx.language))
         return
-    if prefix_arg in await ctx.bot.get_prefixes(ctx.guild):
+    # cached prefixes may be defaults if the database is slow
+    custom_prefixes = (await ctx.bot.guild_settings.load(ctx.guild)).prefixes or []
+    if prefix_arg in (custom_prefixes or ctx.bot.config["prefix"]):
         await ctx.send(t("prefix.add.already_exists", ctx.language, prefix=prefix_arg))
         return
-    custom_prefixes = await ctx.bot.get_prefixes(ctx.guild, False)
     if len(custom_prefixes) >= MAX_PREFIXES_PER_GUILD:
         await ctx.send(
             t("prefix.add.limit_reached", ctx.language, limit=MAX_PREFIXES_PER_GUILD)
         )
         return
-    custom_prefixes.append(prefix_arg)
-    custom_prefixes.sort(key=len, reverse=True)
+    custom_prefixes = sorted([*custom_prefixes, prefix_arg], key=len, reverse=True)
     await ctx.bot.guilds_data.upsert(
-        guild_id=str(ctx.guild.id),
+        guild_id=ctx.guild.id,
         prefixes=custom_prefixes,
     )
-    await ctx.bot.get_prefixes.delete(ctx.guild)
-    await ctx.bot.get_prefixes.delete(ctx.guild, False)
     await ctx.send(t("prefix.add.added", ctx.language, prefix=prefix_arg))
 
 
@@ -43,20 +41,18 @@ async def add(ctx, *, prefix_arg: str):
 @commands.has_permissions(manage_guild=True)
 async def remove(ctx, *, prefix_arg: str):
     "prefix.remove.help"
-    custom_prefixes = await ctx.bot.get_prefixes(ctx.guild, False)
+    custom_prefixes = (await ctx.bot.guild_settings.load(ctx.guild)).prefixes or []
     if not custom_prefixes:
         await ctx.send(t("prefix.remove.no_prefixes", ctx.language))
         return
     if prefix_arg not in custom_prefixes:
         await ctx.send(t("prefix.remove.not_found", ctx.language, prefix=prefix_arg))
         return
-    custom_prefixes.remove(prefix_arg)
+    custom_prefixes = [p for p in custom_prefixes if p != prefix_arg]
     await ctx.bot.guilds_data.upsert(
-        guild_id=str(ctx.guild.id),
+        guild_id=ctx.guild.id,
         prefixes=custom_prefixes,
     )
-    await ctx.bot.get_prefixes.delete(ctx.guild)
-    await ctx.bot.get_prefixes.delete(ctx.guild, False)
     await ctx.send(t("prefix.remove.removed", ctx.language, prefix=prefix_arg))
 
 
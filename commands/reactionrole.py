@@ -3,12 +3,13 @@ import logging as log
 import discord
 from discord import Message, PartialEmoji, RawReactionActionEvent
 from discord.ext import commands, pages
-from sqlalchemy import Column, String
+from sqlalchemy import BigInteger, Column, String
 
 from modules import regexps, embed
 from modules.i18n import t
-from modules.db import WrappedTable
-from modules.utils import chunks
+from modules.db import MULTIPLE_VALUES, WrappedTable, transaction
+from modules.cache import LRUCache
+from modules.utils import achunks
 from modules.converters import ReactionConverter, ManageableRole, SameGuildMessage
 from modules.prima import (
     HTTP_INVALID_FORM_BODY,
@@ -20,11 +21,12 @@ from modules.prima import (
 rr_table = WrappedTable(
     "reaction_roles",
     None,
-    Column("guild_id", String(25), nullable=False),
-    Column("channel_id", String(25), nullable=False),
-    Column("message_id", String(25), nullable=False),
-    Column("reaction", String(25), nullable=False),
-    Column("role_id", String(25), nullable=False),
+    Column("guild_id", BigInteger, nullable=False),
+    Column("channel_id", BigInteger, nullable=False),
+    Column("message_id", BigInteger, primary_key=True),
+    Column("reaction", String(25), primary_key=True),
+    Column("role_id", BigInteger, nullable=False),
+    coalesce=True,
 )
 
 
@@ -33,6 +35,42 @@ class ReactionRole(commands.Cog):
         self.bot = bot
         self.data = rr_table
         self.data.engine = bot.sql
+        self.data.read_engine = bot.read_sql
+        # reactions and roles of messages, looked up on every reaction
+        self.cache: LRUCache[int, list[tuple[str, int]]] = LRUCache(
+            bot.config["reaction_role_cache_size"]
+        )
+        # changes on every invalidation, see GuildSettingsCache
+        self._generation = 0
+        self.data.watchers.append(self.on_write)
+        bot.invalidation.subscribe(self.data, self.on_write)
+
+    def cog_unload(self):
+        self.data.watchers.remove(self.on_write)
+        self.bot.invalidation.unsubscribe(self.data, self.on_write)
+
+    def on_write(self, values: dict):
+        self._generation += 1
+        message_id = values.get("message_id")
+        if message_id is None:
+            self.cache.clear()
+        elif isinstance(message_id, MULTIPLE_VALUES):
+            for i in message_id:
+                self.cache.pop(i)
+        else:
+            self.cache.pop(message_id)
+
+    async def get_reactions(self, message_id: int) -> list[tuple[str, int]]:
+        "Returns reactions of the message and roles they give"
+        reactions = self.cache.get(message_id)
+        if reactions is None:
+            generation = self._generation
+            reactions = await self.data.select(
+                "reaction", "role_id", message_id=message_id
+            )
+            if generation == self._generation:
+                self.cache[message_id] = reactions
+        return reactions
 
     @staticmethod
     def get_raw(emoji: PartialEmoji | str) -> str:
@@ -60,7 +98,7 @@ class ReactionRole(commands.Cog):
         raw_reaction = self.get_raw(reaction)
         if any(
             r == raw_reaction
-            for r, in await self.data.select("reaction", message_id=str(message.id))
+            for r, in await self.data.select("reaction", message_id=message.id)
         ):
             return await ctx.send(t("reactionrole.add.already_taken", ctx.language))
         try:
@@ -74,11 +112,11 @@ class ReactionRole(commands.Cog):
                 e.code = HTTP_UNKNOWN_EMOJI
             raise
         await self.data.insert(
-            guild_id=str(ctx.guild.id),
-            channel_id=str(message.channel.id),
-            message_id=str(message.id),
+            guild_id=ctx.guild.id,
+            channel_id=message.channel.id,
+            message_id=message.id,
             reaction=raw_reaction,
-            role_id=str(role.id),
+            role_id=role.id,
         )
         em = embed.Embed(ctx)
         em.add_field(
@@ -97,13 +135,13 @@ class ReactionRole(commands.Cog):
     async def list(self, ctx):
         "reactionrole.list.help"
         list_pages = []
-        for ch in chunks(
-            await self.data.select(
+        async for ch in achunks(
+            self.data.stream(
                 "channel_id",
                 "message_id",
                 "reaction",
                 "role_id",
-                guild_id=str(ctx.guild.id),
+                guild_id=ctx.guild.id,
             ),
             10,
         ):
@@ -144,25 +182,23 @@ class ReactionRole(commands.Cog):
         message_id = message.id if isinstance(message, Message) else message
         raw_reaction = self.get_raw(reaction)
         for reaction, role_id in await self.data.select(
-            "reaction", "role_id", message_id=str(message_id)
+            "reaction", "role_id", message_id=message_id
         ):
             if reaction == raw_reaction:
                 # converter will raise an error on failure
-                await ManageableRole().convert(ctx, role_id)
-                await self.data.delete(message_id=str(message_id), reaction=raw_reaction)
+                await ManageableRole().convert(ctx, str(role_id))
+                await self.data.delete(message_id=message_id, reaction=raw_reaction)
                 await ctx.send(t("reactionrole.remove.removed", ctx.language))
                 return
         await ctx.send(t("reactionrole.remove.not_found", ctx.language))
 
     async def handle_reaction(self, payload: RawReactionActionEvent, method_name: str):
         raw_emoji = self.get_raw(payload.emoji)
-        for reaction, role_id in await self.data.select(
-            "reaction", "role_id", message_id=str(payload.message_id)
-        ):
+        for reaction, role_id in await self.get_reactions(payload.message_id):
             if reaction == raw_emoji:
                 guild = self.bot.get_guild(payload.guild_id)
                 member = guild.get_member(payload.user_id)
-                role = guild.get_role(int(role_id))
+                role = guild.get_role(role_id)
                 if member and not member.bot and role and role < guild.me.top_role:
                     await getattr(member, method_name)(
                         role,
@@ -189,26 +225,43 @@ class ReactionRole(commands.Cog):
             log.info("Completed.")
 
     async def clean_removed(self):
+        channels, messages, roles = set(), set(), set()
         for guild in self.bot.guilds:
+            # read before any requests to Discord, which would keep
+            # the connection and its cursor busy for a long time
+            rows = {
+                tuple(row)
+                async for row in self.data.stream(
+                    "channel_id", "message_id", "role_id", guild_id=guild.id
+                )
+            }
             checked_messages = set()
-            for c, m, r in await self.data.select(
-                "channel_id", "message_id", "role_id", guild_id=str(guild.id)
-            ):
-                channel = self.bot.get_channel(int(c))
+            for c, m, r in rows:
+                if c in channels:
+                    continue
+                channel = self.bot.get_channel(c)
                 if not channel:
-                    await self.data.delete(channel_id=c)
+                    channels.add(c)
                     continue
                 if m not in checked_messages:
                     checked_messages.add(m)
                     try:
-                        await channel.fetch_message(int(m))
+                        await channel.fetch_message(m)
                     except discord.NotFound:
-                        await self.data.delete(message_id=m)
+                        messages.add(m)
                         continue
                     except Exception:
                         pass
-                if not guild.get_role(int(r)):
-                    await self.data.delete(role_id=r)
+                if not guild.get_role(r):
+                    roles.add(r)
+        async with transaction(self.bot.sql):
+            for column, values in (
+                ("channel_id", channels),
+                ("message_id", messages),
+                ("role_id", roles),
+            ):
+                if values:
+                    await self.data.delete(**{column: list(values)})
 
 
 def setup(bot):
@@ -5,7 +5,7 @@ from datetime import datetime, timezone
 
 from discord import DMChannel, Forbidden, NotFound
 from discord.ext import commands, tasks
-from sqlalchemy import Column, Float, String
+from sqlalchemy import BigInteger, Column, Float, Index, String
 
 from modules.db import WrappedTable
 from modules.i18n import t
@@ -18,10 +18,12 @@ MAX_REMINDER_LEN = 1000
 reminders_table = WrappedTable(
     "reminders",
     None,
-    Column("requester_id", String(25), nullable=False),
-    Column("channel_id", String(25), nullable=False),
-    Column("time", Float, nullable=False),
+    Column("requester_id", BigInteger, nullable=False),
+    Column("channel_id", BigInteger, nullable=False),
+    # sender_loop looks for due reminders
+    Column("time", Float, nullable=False, index=True),
     Column("subject", String(MAX_REMINDER_LEN), nullable=False),
+    Index("ix_reminders_requester_id_channel_id", "requester_id", "channel_id"),
 )
 PATTERNS = [re.compile(f + r"(?!\S)", re.I) for f in TIMEFORMATS]
 PATTERNS.append(re.compile(QUOTED_PATTERN))
@@ -32,6 +34,7 @@ class Remind(commands.Cog):
         self.bot = bot
         self.data = reminders_table
         self.data.engine = bot.sql
+        self.data.read_engine = bot.read_sql
         self.sender_loop.start()
 
     def cog_unload(self):
@@ -80,8 +83,8 @@ class Remind(commands.Cog):
             )
             return
         await self.data.insert(
-            requester_id=str(ctx.author.id),
-            channel_id=str(ctx.channel.id),
+            requester_id=ctx.author.id,
+            channel_id=ctx.channel.id,
             time=timestamp,
             subject=subject,
         )
@@ -90,11 +93,11 @@ class Remind(commands.Cog):
     @remind.command()
     async def list(self, ctx):
         "remind.list.help"
-        async with self.bot.sql.connect() as conn:
+        async with self.data.reader().connect() as conn:
             reminds = await conn.execute(
                 self.data.table.select()
-                .where(self.data.table.c.requester_id == str(ctx.author.id))
-                .where(self.data.table.c.channel_id == str(ctx.channel.id))
+                .where(self.data.table.c.requester_id == ctx.author.id)
+                .where(self.data.table.c.channel_id == ctx.channel.id)
                 .order_by(self.data.table.c.time)
             )
             reminds = reminds.all()
@@ -117,8 +120,8 @@ class Remind(commands.Cog):
         async with self.bot.sql.connect() as conn:
             reminds = await conn.execute(
                 self.data.table.select()
-                .where(self.data.table.c.requester_id == str(ctx.author.id))
-                .where(self.data.table.c.channel_id == str(ctx.channel.id))
+                .where(self.data.table.c.requester_id == ctx.author.id)
+                .where(self.data.table.c.channel_id == ctx.channel.id)
                 .order_by(self.data.table.c.time)
             )
             reminds = reminds.all()
@@ -126,8 +129,8 @@ class Remind(commands.Cog):
             return await ctx.send(t("remind.remove.invalid_number", ctx.language))
         _, _, time, reminder = reminds[num - 1]
         await self.data.delete(
-            requester_id=str(ctx.author.id),
-            channel_id=str(ctx.channel.id),
+            requester_id=ctx.author.id,
+            channel_id=ctx.channel.id,
             time=time,
             subject=reminder,
         )
@@ -149,8 +152,8 @@ class Remind(commands.Cog):
             await bot_msg.edit(t("remind.clear.cancelled", ctx.language))
             return
         await self.data.delete(
-            requester_id=str(ctx.author.id),
-            channel_id=str(ctx.channel.id),
+            requester_id=ctx.author.id,
+            channel_id=ctx.channel.id,
         )
         await ctx.send(t("remind.clear.cleared", ctx.language))
 
@@ -158,9 +161,9 @@ class Remind(commands.Cog):
     async def sender_loop(self):
         time = datetime.now(timezone.utc).timestamp()
         if self.bot.test_mode:
-            condition = self.data.table.c.channel_id == str(self.bot.test_channel_id)
+            condition = self.data.table.c.channel_id == self.bot.test_channel_id
         else:
-            condition = self.data.table.c.channel_id != str(self.bot.test_channel_id)
+            condition = self.data.table.c.channel_id != self.bot.test_channel_id
         try:
             async with self.bot.sql.begin() as conn:
                 reminders = await conn.execute(
@@ -179,7 +182,7 @@ class Remind(commands.Cog):
             return
         await gather(
             *(
-                self.send_reminder(int(user_id), int(channel_id), subject)
+                self.send_reminder(user_id, channel_id, subject)
                 for user_id, channel_id, subject in reminders
             )
         )
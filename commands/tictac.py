@@ -1,8 +1,7 @@
 from discord import Message, User
 from discord.ext import commands
 from discord.utils import escape_markdown
-from sqlalchemy import Column, Integer, String
-from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import BigInteger, Column, Integer
 
 from modules.i18n import t
 from modules.regexps import ID
@@ -14,7 +13,7 @@ from modules.converters import SmartUserConverter
 ttt_table = WrappedTable(
     "ttt_stats",
     None,
-    Column("user_id", String(25), primary_key=True),
+    Column("user_id", BigInteger, primary_key=True),
     Column("total_games", Integer, nullable=False),
     Column("won_games", Integer, nullable=False),
 )
@@ -26,6 +25,10 @@ class TicTac(commands.Cog):
         self.tictac_sessions = {}
         self.stats_table = ttt_table
         self.stats_table.engine = bot.sql
+        self.stats_table.read_engine = bot.read_sql
+
+    def cog_unload(self):
+        self.bot.router.remove(self.handle_message)
 
     @commands.group(
         usage="tictac.usage",
@@ -79,6 +82,7 @@ class TicTac(commands.Cog):
             await ctx.send(**self._build_message(ctx.channel.id, curr_sess)),
             curr_sess,
         )
+        self.bot.router.subscribe(self.handle_message, channel_id=ctx.channel.id)
 
     async def _update(self, channel_id: int, resend: bool = False):
         data = self.tictac_sessions.get(channel_id)
@@ -94,6 +98,7 @@ class TicTac(commands.Cog):
             await message.edit(**self._build_message(channel_id, session))
         if session.winner or session.draw or session.stopped:
             del self.tictac_sessions[channel_id]
+            self.bot.router.unsubscribe(self.handle_message, channel_id=channel_id)
             if session.stopped:
                 return
             # update stats only if game was "fair"
@@ -102,9 +107,11 @@ class TicTac(commands.Cog):
                 or session.win_size == 3
                 and len(session.board) == 3
             ):
-                players = [ID.search(p).group() for p in session.players]
-                winner = ID.search(session.winner).group() if session.winner else None
-                await self.update_stats(players, winner)
+                players = [int(ID.search(p).group()) for p in session.players]
+                winner = (
+                    int(ID.search(session.winner).group()) if session.winner else None
+                )
+                self.update_stats(players, winner)
         else:
             self.tictac_sessions[channel_id] = (message, session)
 
@@ -134,9 +141,9 @@ class TicTac(commands.Cog):
     async def stats(self, ctx, user: SmartUserConverter = None):
         "tictac.stats.help"
         user = user or ctx.author
-        data = await self.stats_table.select(
-            "total_games", "won_games", user_id=str(user.id)
-        )
+        # include games that haven't been written yet
+        await self.stats_table.flush()
+        data = await self.stats_table.select("total_games", "won_games", user_id=user.id)
         if data:
             total, won = data[0]
         else:
@@ -152,25 +159,13 @@ class TicTac(commands.Cog):
             )
         )
 
-    async def update_stats(self, gamers: list[str], winner: str | None):
-        async with self.bot.sql.begin() as conn:
-            await conn.execute(
-                insert(self.stats_table.table).on_conflict_do_update(
-                    constraint=self.stats_table.table.primary_key,
-                    set_={
-                        "total_games": self.stats_table.table.c.total_games + 1,
-                        "won_games": self.stats_table.table.c.won_games
-                        + (self.stats_table.table.c.user_id == winner).cast(Integer),
-                    },
-                ),
-                [
-                    {"user_id": g, "total_games": 1, "won_games": int(g == winner)}
-                    for g in gamers
-                ],
+    def update_stats(self, gamers: list[int], winner: int | None):
+        for g in gamers:
+            self.stats_table.buffer_increment(
+                user_id=g, total_games=1, won_games=int(g == winner)
             )
 
-    @commands.Cog.listener()
-    async def on_message(self, message: Message):
+    async def handle_message(self, message: Message):
         curr_sess = self.tictac_sessions.get(message.channel.id, None)
         if curr_sess is None:
             return
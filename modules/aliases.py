@@ -0,0 +1,257 @@
+from re import compile
+from math import inf
+from time import monotonic
+from heapq import merge
+from string import Formatter
+from typing import Iterable
+
+import regex
+from discord import Message
+
+from .redos import worst_case_time
+from .regexps import ARG, VAR_ARG, ARGUMENT_TEMPLATE, SIDE_QUOTES
+
+VAR_ARG_GROUP = "_VAR_ARG"
+# variable argument goes first, like when they're substituted one by one
+PLACEHOLDER = compile(f"{VAR_ARG.pattern}|{ARG.pattern}")
+MATCH_TIMEOUT = 1
+# command name is read up to whitespace, like discord.py does
+FIRST_WORD = compile(r"\S*")
+# characters that make a word of a pattern not literal
+SPECIAL_CHARS = frozenset("\\.^$*+?{}[]()|")
+QUANTIFIERS = frozenset("*+?{")
+
+_formatter = Formatter()
+
+
+def translate_pattern(pattern: str) -> str:
+    "Turns alias pattern into a regular expression"
+    pattern = ARG.sub(lambda g: ARGUMENT_TEMPLATE % g.group(1), pattern)
+    return VAR_ARG.sub(f"(?P<{VAR_ARG_GROUP}>.+?)", pattern)
+
+
+def parse_template(command: str) -> list[str | tuple]:
+    """
+    Splits command into literal text, ("arg", name), ("var",)
+    and ("field", name, conversion, spec) parts.
+    Raises ValueError if command isn't a valid format string.
+    """
+    parts = []
+    for literal, field, spec, conversion in _formatter.parse(command):
+        start = 0
+        for placeholder in PLACEHOLDER.finditer(literal):
+            parts.append(literal[start : placeholder.start()])
+            if placeholder.group(1) is None:
+                parts.append(("var",))
+            else:
+                parts.append(("arg", placeholder.group(1)))
+            start = placeholder.end()
+        parts.append(literal[start:])
+        if field is not None:
+            parts.append(("field", field, conversion, spec))
+    return [p for p in parts if p]
+
+
+class AliasStep:
+    """
+    Line of alias command split into name of the command to invoke
+    and template of its arguments. Name is None if it's not literal.
+    """
+
+    __slots__ = ("command_name", "arguments")
+
+    def __init__(self, line: str):
+        parts = parse_template(line)
+        self.command_name: str | None = None
+        self.arguments: list[str | tuple] = parts
+        if not parts:
+            self.command_name = ""
+        elif isinstance(parts[0], str):
+            name = FIRST_WORD.match(parts[0]).group()
+            if len(name) < len(parts[0]) or len(parts) == 1:
+                self.command_name = name
+                rest = parts[0][len(name) :]
+                self.arguments = [rest, *parts[1:]] if rest else parts[1:]
+
+    def render(self, groups: dict, kwargs: dict) -> tuple[str, str]:
+        "Returns name of the command and its arguments"
+        arguments = render_template(self.arguments, groups, kwargs)
+        if self.command_name is not None:
+            return self.command_name, arguments
+        name = FIRST_WORD.match(arguments).group()
+        return name, arguments[len(name) :]
+
+
+def render_template(parts: list[str | tuple], groups: dict, kwargs: dict) -> str:
+    """
+    Substitutes matched groups and format fields.
+    Raises KeyError or AttributeError on invalid field.
+    """
+    result = []
+    for part in parts:
+        if isinstance(part, str):
+            result.append(part)
+        elif part[0] == "var":
+            value = groups.get(VAR_ARG_GROUP)
+            result.append("$*" if value is None else value)
+        elif part[0] == "arg":
+            value = groups.get(part[1])
+            if value is None:
+                result.append("$" + part[1])
+            else:
+                result.append(SIDE_QUOTES.sub("", value).replace("\\", ""))
+        else:
+            _, field, conversion, spec = part
+            value = _formatter.get_field(field, (), kwargs)[0]
+            value = _formatter.convert_field(value, conversion)
+            result.append(_formatter.format_field(value, spec))
+    return "".join(result)
+
+
+class CompiledAlias:
+    "Alias with pattern compiled and command split into steps once"
+
+    __slots__ = ("pattern", "command", "regex", "steps")
+
+    def __init__(self, pattern: str, command: str):
+        self.pattern = pattern
+        self.command = command
+        try:
+            self.regex = regex.compile(
+                translate_pattern(pattern), regex.I | regex.DOTALL
+            )
+        except regex.error:
+            self.regex = None
+        try:
+            self.steps = [AliasStep(line) for line in command.split("\n")]
+        except ValueError:
+            self.steps = None
+
+    def match(self, text: str, timeout: float = MATCH_TIMEOUT) -> regex.Match | None:
+        "Raises TimeoutError if matching takes longer than timeout"
+        if self.regex is None or self.steps is None:
+            return None
+        return self.regex.fullmatch(text, timeout=timeout)
+
+    def worst_case_time(self, timeout: float) -> float:
+        "Measures matching time on inputs that are likely to be slow"
+        if self.regex is None:
+            return 0.0
+        word = literal_first_word(self.pattern)
+        return worst_case_time(self.regex, timeout, (word + " ",) if word else ())
+
+    def render(self, match: regex.Match, message: Message) -> list[tuple[str, str]]:
+        """
+        Builds (command name, arguments) pairs for the match.
+        Raises KeyError or AttributeError on invalid field.
+        """
+        groups = match.groupdict()
+        kwargs = {"message": message, "user": message.author}
+        return [step.render(groups, kwargs) for step in self.steps]
+
+
+def literal_first_word(pattern: str) -> str | None:
+    """
+    Returns the first word of a pattern if every matching text must start with it,
+    None otherwise. The word is casefolded as aliases ignore case.
+    """
+    if "|" in pattern:
+        # top-level alternation makes any prefix optional
+        return None
+    end = 0
+    while end < len(pattern) and not pattern[end].isspace():
+        if pattern[end] in SPECIAL_CHARS:
+            return None
+        end += 1
+    if end == 0:
+        return None
+    if end + 1 < len(pattern) and pattern[end + 1] in QUANTIFIERS:
+        # the space after the word is optional or repeated
+        return None
+    return pattern[:end].casefold()
+
+
+def first_word(text: str) -> str:
+    words = text.split(None, 1)
+    return words[0].casefold() if words else ""
+
+
+class AliasIndex:
+    """
+    Aliases grouped by literal first word of their pattern,
+    so that a message is matched only against plausible candidates.
+    Aliases with no such word are always candidates.
+    """
+
+    def __init__(self, aliases: dict[str, str]):
+        self._by_word: dict[str, list[tuple[int, CompiledAlias]]] = {}
+        self._fallback: list[tuple[int, CompiledAlias]] = []
+        for i, (pattern, command) in enumerate(aliases.items()):
+            word = literal_first_word(pattern)
+            if word is None:
+                bucket = self._fallback
+            else:
+                bucket = self._by_word.setdefault(word, [])
+            bucket.append((i, CompiledAlias(pattern, command)))
+
+    def __len__(self) -> int:
+        return len(self._fallback) + sum(map(len, self._by_word.values()))
+
+    def candidates(self, text: str) -> Iterable[CompiledAlias]:
+        "Yields aliases that may match the text in order of their definition"
+        by_word = self._by_word.get(first_word(text))
+        if by_word and self._fallback:
+            candidates = merge(by_word, self._fallback)
+        else:
+            candidates = by_word or self._fallback
+        for _, alias in candidates:
+            yield alias
+
+
+def match_candidates(
+    aliases: Iterable[CompiledAlias], text: str, budget: float
+) -> tuple[list[tuple[CompiledAlias, regex.Match]], list[CompiledAlias], float]:
+    """
+    Matches aliases against the text until the time budget runs out.
+    Returns matches, aliases that timed out and time spent.
+    Meant to be run in a thread as regex releases the GIL.
+    """
+    start = monotonic()
+    deadline = start + budget
+    matches = []
+    timed_out = []
+    for alias in aliases:
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            # the rest is skipped, they aren't to blame
+            break
+        try:
+            match = alias.match(text, remaining)
+        except TimeoutError:
+            timed_out.append(alias)
+            continue
+        if match:
+            matches.append((alias, match))
+    return matches, timed_out, monotonic() - start
+
+
+class TimeBudgets:
+    "Limits how much time can be spent on each key during a period"
+
+    def __init__(self, limit: float, period: float):
+        self.limit = limit
+        self.period = period
+        self._spent: dict[int, tuple[float, float]] = {}
+
+    def remaining(self, key: int) -> float:
+        period_start, spent = self._spent.get(key, (-inf, 0.0))
+        if monotonic() - period_start >= self.period:
+            return self.limit
+        return self.limit - spent
+
+    def spend(self, key: int, seconds: float):
+        now = monotonic()
+        period_start, spent = self._spent.get(key, (-inf, 0.0))
+        if now - period_start >= self.period:
+            period_start, spent = now, 0.0
+        self._spent[key] = (period_start, spent + seconds)
@@ -1,32 +1,344 @@
-from sqlalchemy import MetaData, Table
-from sqlalchemy.dialects.postgresql import insert
+import asyncio
+import logging as log
+from contextvars import ContextVar
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Iterable
+from math import inf
+from time import monotonic, perf_counter
+from collections import Counter
+
+from sqlalchemy import (
+    Executable,
+    MetaData,
+    Row,
+    Table,
+    bindparam,
+    event,
+    make_url,
+    select,
+)
+from sqlalchemy.pool import AsyncAdaptedQueuePool, Pool
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, create_async_engine
 
 metadata = MetaData()
+# condition values of these types are matched with IN
+MULTIPLE_VALUES = (list, tuple, set, frozenset)
+# keeps parameters of conditions apart from values of updated columns
+WHERE_PREFIX = "where_"
+# rows fetched at a time by streaming selects
+DEFAULT_BATCH_SIZE = 1000
+# all wrapped tables by name
+tables: dict[str, "WrappedTable"] = {}
+# dialects that support INSERT ... ON CONFLICT
+INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+# set on every SQLite connection, the database is used by one process
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+    "cache_size": -64000,
+    "mmap_size": 268435456,
+    "busy_timeout": 5000,
+}
+
+
+class PoolStats:
+    "Counts how long getting a connection from the pool took"
+
+    # upper bounds of histogram buckets in seconds
+    BUCKETS = (0.001, 0.01, 0.1, 1.0, inf)
+    LABELS = ("<= 1 ms", "<= 10 ms", "<= 100 ms", "<= 1 s", "> 1 s")
+
+    def __init__(self):
+        self.waits = Counter()
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        self.waits[next(b for b in self.BUCKETS if seconds <= b)] += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def describe(self, name: str) -> list[str]:
+        count = sum(self.waits.values())
+        return [
+            f"{name} waits: {count}, avg {self.total / (count or 1) * 1000:.2f} ms,"
+            f" max {self.max * 1000:.2f} ms"
+        ] + [
+            f"{name} waits {label}: {self.waits[bucket]}"
+            for bucket, label in zip(self.BUCKETS, self.LABELS)
+        ]
+
+
+class TimedPool(AsyncAdaptedQueuePool):
+    "Records time spent waiting for a connection into its stats"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.stats.record(perf_counter() - start)
+
+
+def describe_pool(pool: Pool, name: str = "pool") -> list[str]:
+    lines = [f"{name}: {pool.status()}"]
+    if isinstance(pool, TimedPool):
+        lines.extend(pool.stats.describe(name))
+    return lines
+
+
+def create_engine(
+    url: str, statement_cache_size: int = 100, **pool_options
+) -> AsyncEngine:
+    "Pool options are passed to create_async_engine unless the database is in memory"
+    url = make_url(url)
+    options = {}
+    if url.get_driver_name() == "asyncpg":
+        options["connect_args"] = {"prepared_statement_cache_size": statement_cache_size}
+    if url.get_backend_name() != "sqlite" or url.database not in (None, "", ":memory:"):
+        options["poolclass"] = TimedPool
+        options.update(pool_options)
+    engine = create_async_engine(url, **options)
+    if engine.dialect.name == "sqlite":
+
+        @event.listens_for(engine.sync_engine, "connect")
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in SQLITE_PRAGMAS.items():
+                cursor.execute(f"PRAGMA {name} = {value}")
+            cursor.close()
+
+    return engine
+
+
+class Transaction:
+    "Connection shared by writes inside transaction()"
+
+    def __init__(self, conn: AsyncConnection):
+        self.conn = conn
+        self.active = True
+        # watchers are notified once changes are visible to others
+        self.notifications: list[tuple[WrappedTable, dict]] = []
+
+
+_transaction: ContextVar[Transaction | None] = ContextVar("transaction", default=None)
+
+
+def current_transaction() -> Transaction | None:
+    # tasks started inside a transaction keep its context after it ends
+    transaction = _transaction.get()
+    return transaction if transaction is not None and transaction.active else None
+
+
+@asynccontextmanager
+async def transaction(engine: AsyncEngine) -> AsyncIterator[AsyncConnection]:
+    """
+    Makes writes of WrappedTables inside use one transaction.
+    Nested calls join the outer transaction.
+    """
+    current = current_transaction()
+    if current is not None:
+        yield current.conn
+        return
+    async with engine.begin() as conn:
+        current = Transaction(conn)
+        token = _transaction.set(current)
+        try:
+            yield conn
+        finally:
+            _transaction.reset(token)
+            current.active = False
+    # only after commit, nothing was written if the block raised
+    for table, values in current.notifications:
+        table._notify(values)
 
 
 class WrappedTable:
-    def __init__(self, name: str, engine, *columns):
+    # seconds after a write during which the replica may not have it yet
+    replica_lag = 5.0
+
+    def __init__(
+        self,
+        name: str,
+        engine,
+        *columns,
+        coalesce: bool = False,
+        write_delay: float = 5.0,
+        max_pending_writes: int = 500,
+    ):
         self.name = name
         self.engine = engine
+        # selects go to the replica if there's one
+        self.read_engine = None
+        self._last_write = -inf
         self.table = Table(name, metadata, *columns)
-        self.columns = {c.name: i for i, c in enumerate(self.table.c)}
+        tables[name] = self
+        # whether concurrent identical selects share one query
+        self.coalesce = coalesce
+        self._in_flight: dict[tuple, asyncio.Future] = {}
+        # how many selects were sent to the database and how many joined another one
+        self.read_stats = Counter()
+        # buffered writes are merged by primary key and written together
+        # after the delay or when there are too many of them
+        self.write_delay = write_delay
+        self.max_pending_writes = max_pending_writes
+        self._primary_key = tuple(c.name for c in self.table.primary_key)
+        self._pending_upserts: dict[tuple, dict] = {}
+        self._pending_increments: dict[tuple, dict] = {}
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._flushes: set[asyncio.Task] = set()
+        # called with column values (or conditions) of every write,
+        # writes of many rows give lists of their primary key values
+        self.watchers: list[Callable[[dict], Any]] = []
+        # statements with bound parameters by operation, columns and condition keys,
+        # so that they're built once and SQLAlchemy finds them in its compiled cache
+        self._statements: dict[tuple, Executable] = {}
+
+    def mark_written(self):
+        "Makes reads go to the primary for a while, e.g. after writes of others"
+        self._last_write = monotonic()
+
+    def _notify(self, values: dict):
+        self.mark_written()
+        transaction = current_transaction()
+        if transaction is not None:
+            transaction.notifications.append((self, values))
+            return
+        # selects started before the write may return outdated rows
+        self._in_flight.clear()
+        for watcher in self.watchers:
+            watcher(values)
+
+    def _notify_many(self, rows: list[dict]):
+        "Notifies once about many rows, so that watchers aren't called for each"
+        if len(rows) == 1:
+            self._notify(rows[0])
+            return
+        # other columns don't tell which rows changed
+        keys = set(self._primary_key).intersection(*rows)
+        values = {}
+        for k in keys:
+            merged = set()
+            for row in rows:
+                v = row[k]
+                merged.update(v if isinstance(v, MULTIPLE_VALUES) else (v,))
+            values[k] = list(merged)
+        self._notify(values)
+
+    @staticmethod
+    def _cond_key(where: dict) -> tuple:
+        return tuple((k, isinstance(v, MULTIPLE_VALUES)) for k, v in where.items())
+
+    @staticmethod
+    def _cond_params(where: dict) -> dict:
+        return {
+            WHERE_PREFIX + k: list(v) if isinstance(v, MULTIPLE_VALUES) else v
+            for k, v in where.items()
+        }
 
-    def _add_cond(self, query, where: dict):
-        for k, v in where.items():
-            query = query.where(getattr(self.table.c, k) == v)
+    def _add_cond(self, query, cond_key: tuple):
+        for k, multiple in cond_key:
+            column = self.table.c[k]
+            if multiple:
+                query = query.where(
+                    column.in_(bindparam(WHERE_PREFIX + k, expanding=True))
+                )
+            else:
+                query = query.where(column == bindparam(WHERE_PREFIX + k))
         return query
 
-    async def _select(self, where: dict = {}) -> list:
-        query = self._add_cond(self.table.select(), where)
-        async with self.engine.connect() as conn:
-            return (await conn.execute(query)).all()
+    def _statement(self, key: tuple, build: Callable[[], Executable]) -> Executable:
+        statement = self._statements.get(key)
+        if statement is None:
+            statement = self._statements[key] = build()
+        return statement
 
-    def _extract(self, response: list, columns: list) -> list:
-        columns = [self.columns[name] for name in columns] or range(len(self.columns))
-        return [tuple(row[i] for i in columns) for row in response]
+    async def _select(self, what: tuple = (), where: dict = {}) -> list:
+        if not self.coalesce:
+            return await self._query(what, where)
+        key = (
+            what,
+            tuple(
+                (k, tuple(v) if isinstance(v, MULTIPLE_VALUES) else v)
+                for k, v in where.items()
+            ),
+        )
+        future = self._in_flight.get(key)
+        if future is None:
+            self.read_stats["queries"] += 1
+            future = self._in_flight[key] = asyncio.ensure_future(
+                self._query(what, where)
+            )
+            future.add_done_callback(lambda _: self._forget(key, future))
+        else:
+            self.read_stats["coalesced"] += 1
+        # one caller being cancelled mustn't cancel the query for others
+        return await asyncio.shield(future)
+
+    def _forget(self, key: tuple, future: asyncio.Future):
+        if self._in_flight.get(key) is future:
+            del self._in_flight[key]
+
+    def reader(self) -> AsyncEngine:
+        "Primary is used to read what this process has just written"
+        if (
+            self.read_engine is None
+            or current_transaction() is not None
+            or monotonic() - self._last_write < self.replica_lag
+        ):
+            return self.engine
+        return self.read_engine
+
+    def _select_statement(self, what: tuple, where: dict) -> Executable:
+        cond_key = self._cond_key(where)
+        return self._statement(
+            ("select", what, cond_key),
+            lambda: self._add_cond(
+                (
+                    select(*(self.table.c[name] for name in what))
+                    if what
+                    else self.table.select()
+                ),
+                cond_key,
+            ),
+        )
+
+    async def _query(
+        self, what: tuple, where: dict, engine: AsyncEngine | None = None
+    ) -> list:
+        query = self._select_statement(what, where)
+        async with (engine or self.reader()).connect() as conn:
+            return (await conn.execute(query, self._cond_params(where))).all()
 
     async def select(self, *what, **where) -> list:
-        return self._extract(await self._select(where), what)
+        return [tuple(row) for row in await self._select(what, where)]
+
+    async def select_primary(self, *what, **where) -> list:
+        "Selects from the primary without joining other selects, e.g. before updates"
+        return [tuple(row) for row in await self._query(what, where, self.engine)]
+
+    async def stream(
+        self, *what, batch_size: int = DEFAULT_BATCH_SIZE, **where
+    ) -> AsyncIterator[Row]:
+        """
+        Yields rows from a server-side cursor, fetching batch_size rows at a time.
+        The connection is held until iteration ends.
+        """
+        query = self._select_statement(what, where)
+        async with self.reader().connect() as conn:
+            result = await conn.stream(
+                query,
+                self._cond_params(where),
+                execution_options={"yield_per": batch_size},
+            )
+            async for row in result:
+                yield row
 
     async def insert(self, values=None, **kw_values) -> None:
         if values is not None:
@@ -34,24 +346,200 @@ class WrappedTable:
             values.update(kw_values)
         else:
             values = kw_values
-        async with self.engine.begin() as conn:
+        async with self._begin() as conn:
             await conn.execute(self.table.insert(), values)
+        self._notify(values)
 
     async def update(self, what: dict, where: dict):
-        query = self._add_cond(self.table.update(), where)
-        async with self.engine.begin() as conn:
-            await conn.execute(query, what)
+        cond_key = self._cond_key(where)
+        query = self._statement(
+            ("update", tuple(what), cond_key),
+            lambda: self._add_cond(self.table.update(), cond_key).values(
+                {k: bindparam(k) for k in what}
+            ),
+        )
+        async with self._begin() as conn:
+            await conn.execute(query, what | self._cond_params(where))
+        self._notify(where)
 
     async def delete(self, **where):
-        query = self._add_cond(self.table.delete(), where)
-        async with self.engine.begin() as conn:
-            await conn.execute(query)
+        cond_key = self._cond_key(where)
+        query = self._statement(
+            ("delete", cond_key),
+            lambda: self._add_cond(self.table.delete(), cond_key),
+        )
+        async with self._begin() as conn:
+            await conn.execute(query, self._cond_params(where))
+        self._notify(where)
+
+    @asynccontextmanager
+    async def _begin(self) -> AsyncIterator[AsyncConnection]:
+        "Uses connection of the current transaction if there's one"
+        transaction = current_transaction()
+        if transaction is not None and transaction.conn.engine is self.engine:
+            yield transaction.conn
+        else:
+            async with self.engine.begin() as conn:
+                yield conn
+
+    def _insert(self):
+        "INSERT that supports ON CONFLICT in dialect of the engine"
+        return INSERTS[self.engine.dialect.name](self.table)
+
+    def _build_upsert(self, columns: tuple):
+        query = self._insert()
+        return query.on_conflict_do_update(
+            index_elements=self.table.primary_key.columns,
+            set_={k: query.excluded[k] for k in columns},
+        )
 
     async def upsert(self, **values) -> None:
-        async with self.engine.begin() as conn:
-            await conn.execute(
-                insert(self.table).on_conflict_do_update(
-                    constraint=self.table.primary_key, set_=values
-                ),
-                values,
+        query = self._statement(
+            ("upsert", tuple(values)), lambda: self._build_upsert(tuple(values))
+        )
+        async with self._begin() as conn:
+            await conn.execute(query, values)
+        self._notify(values)
+
+    async def insert_many(self, rows: Iterable[dict]):
+        rows = list(rows)
+        if not rows:
+            return
+        async with self._begin() as conn:
+            await conn.execute(self.table.insert(), rows)
+        self._notify_many(rows)
+
+    async def upsert_many(self, rows: Iterable[dict]):
+        "Rows with the same columns are upserted with one statement"
+        by_columns: dict[tuple, list[dict]] = {}
+        for values in rows:
+            by_columns.setdefault(tuple(values), []).append(values)
+        if not by_columns:
+            return
+        async with self._begin() as conn:
+            for columns, batch in by_columns.items():
+                query = self._statement(
+                    ("upsert", columns), lambda: self._build_upsert(columns)
+                )
+                await conn.execute(query, batch)
+        self._notify_many([values for batch in by_columns.values() for values in batch])
+
+    async def delete_many(self, conditions: Iterable[dict]):
+        """
+        Deletes rows matching any of the conditions.
+        Conditions with the same keys are executed with one statement.
+        """
+        by_keys: dict[tuple, list[dict]] = {}
+        for where in conditions:
+            by_keys.setdefault(self._cond_key(where), []).append(where)
+        if not by_keys:
+            return
+        async with self._begin() as conn:
+            for cond_key, batch in by_keys.items():
+                query = self._statement(
+                    ("delete", cond_key),
+                    lambda: self._add_cond(self.table.delete(), cond_key),
+                )
+                params = [self._cond_params(where) for where in batch]
+                if any(multiple for _, multiple in cond_key):
+                    # expanding IN parameters can't be executed as many
+                    for p in params:
+                        await conn.execute(query, p)
+                else:
+                    await conn.execute(query, params)
+        self._notify_many([where for batch in by_keys.values() for where in batch])
+
+    def _build_increment(self, columns: tuple):
+        query = self._insert()
+        return query.on_conflict_do_update(
+            index_elements=self.table.primary_key.columns,
+            set_={
+                k: self.table.c[k] + query.excluded[k]
+                for k in columns
+                if k not in self._primary_key
+            },
+        )
+
+    def _key(self, values: dict) -> tuple:
+        return tuple(values[k] for k in self._primary_key)
+
+    def buffer_upsert(self, **values):
+        "Upserts later, merging with pending upserts of the same row"
+        key = self._key(values)
+        self._pending_upserts[key] = self._pending_upserts.get(key, {}) | values
+        self._schedule_flush()
+
+    def buffer_increment(self, **values):
+        """
+        Adds values to columns of the row later, inserting it if there's none.
+        Primary key columns are used as is.
+        """
+        self._add_increment(values)
+        self._schedule_flush()
+
+    def _add_increment(self, values: dict):
+        pending = self._pending_increments.setdefault(self._key(values), {})
+        for k, v in values.items():
+            pending[k] = v if k in self._primary_key else pending.get(k, 0) + v
+
+    def _schedule_flush(self):
+        pending = len(self._pending_upserts) + len(self._pending_increments)
+        if pending >= self.max_pending_writes:
+            self._start_flush()
+        else:
+            self._flush_later()
+
+    def _flush_later(self):
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                self.write_delay, self._start_flush
             )
+
+    def _start_flush(self):
+        task = asyncio.ensure_future(self._flush())
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        upserts, self._pending_upserts = self._pending_upserts, {}
+        increments, self._pending_increments = self._pending_increments, {}
+        if not upserts and not increments:
+            return
+        batches = {}
+        for op, pending, build in (
+            ("upsert", upserts, self._build_upsert),
+            ("increment", increments, self._build_increment),
+        ):
+            for values in pending.values():
+                columns = tuple(values)
+                key = (op, columns)
+                if key not in batches:
+                    batches[key] = (self._statement(key, lambda: build(columns)), [])
+                batches[key][1].append(values)
+        try:
+            async with self.engine.begin() as conn:
+                for query, rows in batches.values():
+                    await conn.execute(query, rows)
+        except Exception:
+            log.exception("Failed to write buffered writes to %s", self.name)
+            # try again later, newer writes take precedence
+            for key, values in upserts.items():
+                self._pending_upserts[key] = values | self._pending_upserts.get(key, {})
+            for values in increments.values():
+                self._add_increment(values)
+            self._flush_later()
+            return
+        self._notify_many([*upserts.values(), *increments.values()])
+
+    async def flush(self):
+        "Writes pending buffered writes and waits for ones being written"
+        self._start_flush()
+        await asyncio.gather(*self._flushes)
+
+
+async def flush_all():
+    "Writes buffered writes of all tables, e.g. before shutdown"
+    await asyncio.gather(*(table.flush() for table in tables.values()))
@@ -0,0 +1,137 @@
+"""
+Tells other bot processes which rows were written, so that they drop cached copies.
+Works through PostgreSQL LISTEN/NOTIFY and does nothing with other databases.
+"""
+
+import json
+import asyncio
+import logging as log
+from uuid import uuid4
+from typing import Any, Callable
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from .db import MULTIPLE_VALUES, WrappedTable
+
+CHANNEL = "prima_invalidation"
+# PostgreSQL rejects longer payloads
+MAX_PAYLOAD = 7900
+RECONNECT_DELAY = 5.0
+
+Handler = Callable[[dict], Any]
+
+
+class InvalidationBus:
+    def __init__(self, engine: AsyncEngine | None):
+        self.engine = engine
+        # tells own messages apart
+        self.id = uuid4().hex
+        self._handlers: dict[str, list[Handler]] = {}
+        self._tables: dict[str, WrappedTable] = {}
+        self._conn: AsyncConnection | None = None
+        self._sends: set[asyncio.Task] = set()
+        self._reconnect: asyncio.Future | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.engine is not None and self.engine.dialect.name == "postgresql"
+
+    def subscribe(self, table: WrappedTable, handler: Handler):
+        """
+        Handler is called with primary key values (or {} if unknown)
+        of rows that other processes wrote to the table.
+        Writes of this process to the table are published.
+        """
+        if table.name not in self._tables:
+            self._tables[table.name] = table
+            table.watchers.append(lambda values: self.publish(table, values))
+        self._handlers.setdefault(table.name, []).append(handler)
+
+    def unsubscribe(self, table: WrappedTable, handler: Handler):
+        self._handlers[table.name].remove(handler)
+
+    async def start(self):
+        if not self.enabled:
+            return
+        conn = None
+        try:
+            conn = self._conn = await self.engine.connect()
+            raw = await conn.get_raw_connection()
+            await raw.driver_connection.add_listener(CHANNEL, self._on_notification)
+            raw.driver_connection.add_termination_listener(self._on_termination)
+        except Exception as e:
+            log.error("Failed to listen for invalidations: %s", e)
+            self._conn = None
+            self._reconnect = asyncio.ensure_future(self._reconnect_later(conn))
+
+    async def stop(self):
+        if self._reconnect is not None:
+            self._reconnect.cancel()
+        if self._sends:
+            await asyncio.wait(self._sends)
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            await conn.close()
+
+    def publish(self, table: WrappedTable, values: dict):
+        if not self.enabled:
+            return
+        keys = {}
+        for k in table.table.primary_key.columns.keys():
+            if k in values:
+                v = values[k]
+                keys[k] = list(v) if isinstance(v, MULTIPLE_VALUES) else v
+        payload = json.dumps({"id": self.id, "table": table.name, "keys": keys})
+        if len(payload) > MAX_PAYLOAD:
+            # receivers drop everything they have for the table
+            payload = json.dumps({"id": self.id, "table": table.name, "keys": {}})
+        task = asyncio.ensure_future(self._send(payload))
+        self._sends.add(task)
+        task.add_done_callback(self._sends.discard)
+
+    async def _send(self, payload: str):
+        try:
+            async with self.engine.begin() as conn:
+                await conn.execute(
+                    text("SELECT pg_notify(:channel, :payload)"),
+                    {"channel": CHANNEL, "payload": payload},
+                )
+        except Exception as e:
+            log.error("Failed to publish invalidation: %s", e)
+
+    def _on_notification(self, connection, pid: int, channel: str, payload: str):
+        message = json.loads(payload)
+        if message["id"] == self.id:
+            return
+        table = self._tables.get(message["table"])
+        if table is not None:
+            # reloads must not get rows from before the write from the replica
+            table.mark_written()
+        for handler in self._handlers.get(message["table"], ()):
+            handler(message["keys"])
+
+    def _on_termination(self, connection):
+        if self._conn is None:
+            # stopped
+            return
+        log.warning("Lost connection listening for invalidations")
+        conn, self._conn = self._conn, None
+        # whatever was missed can't be known
+        for table in self._tables.values():
+            table.mark_written()
+        for handlers in self._handlers.values():
+            for handler in handlers:
+                handler({})
+        self._reconnect = asyncio.ensure_future(self._reconnect_later(conn))
+
+    async def _reconnect_later(self, broken: AsyncConnection | None):
+        if broken is not None:
+            # gives the pool slot back, the connection itself isn't reused
+            try:
+                await broken.invalidate()
+                await broken.close()
+            except Exception as e:
+                log.warning("Failed to close broken connection: %s", e)
+        await asyncio.sleep(RECONNECT_DELAY)
+        await self.start()
@@ -0,0 +1,138 @@
+"""
+Versioned schema migrations run at startup.
+Fresh databases get the current schema from metadata and are stamped
+with the latest version, existing ones are brought to it step by step.
+SQLite databases are always fresh, as SQLite is supported only since version 4.
+"""
+
+import logging as log
+
+from sqlalchemy import (
+    JSON,
+    BigInteger,
+    Column,
+    Connection,
+    Integer,
+    Table,
+    column,
+    inspect,
+    table,
+    text,
+)
+
+from .db import metadata
+
+schema_version = Table(
+    "schema_version", metadata, Column("version", Integer, nullable=False)
+)
+# columns with Discord IDs that used to be strings
+SNOWFLAKE_COLUMNS = {
+    "guilds": ("guild_id", "autorole"),
+    "aliases": ("guild_id",),
+    "reaction_roles": ("guild_id", "channel_id", "message_id", "role_id"),
+    "reminders": ("requester_id", "channel_id"),
+    "ttt_stats": ("user_id",),
+}
+
+
+def _has_table(conn: Connection, name: str) -> bool:
+    "Tables of extensions that aren't loaded aren't migrated"
+    return name in metadata.tables and inspect(conn).has_table(name)
+
+
+def move_aliases(conn: Connection):
+    "Moves aliases from JSON column of the guilds table to the aliases table"
+    if "aliases" not in {c["name"] for c in inspect(conn).get_columns("guilds")}:
+        return
+    aliases = column("aliases", JSON)
+    rows = conn.execute(
+        table("guilds", column("guild_id"), aliases).select().where(aliases.is_not(None))
+    ).all()
+    values = [
+        # position keeps the order in which aliases were added
+        {
+            "guild_id": int(guild_id),
+            "pattern": pattern,
+            "command": command,
+            "created_at": i,
+        }
+        for guild_id, guild_aliases in rows
+        for i, (pattern, command) in enumerate((guild_aliases or {}).items())
+    ]
+    if values:
+        conn.execute(metadata.tables["aliases"].insert(), values)
+    conn.execute(text("ALTER TABLE guilds DROP COLUMN aliases"))
+    log.info(
+        "Moved %d aliases of %d guilds to the aliases table", len(values), len(rows)
+    )
+
+
+def add_reminder_indexes(conn: Connection):
+    if not _has_table(conn, "reminders"):
+        return
+    for index in metadata.tables["reminders"].indexes:
+        index.create(conn, checkfirst=True)
+
+
+def add_reaction_role_key(conn: Connection):
+    if not _has_table(conn, "reaction_roles"):
+        return
+    if inspect(conn).get_pk_constraint("reaction_roles")["constrained_columns"]:
+        return
+    # one reaction of a message gives one role, keep any of the duplicates
+    deleted = conn.execute(
+        text(
+            "DELETE FROM reaction_roles a USING reaction_roles b"
+            " WHERE a.ctid < b.ctid"
+            " AND a.message_id = b.message_id AND a.reaction = b.reaction"
+        )
+    ).rowcount
+    if deleted:
+        log.warning("Deleted %d duplicate reaction roles", deleted)
+    conn.execute(
+        text("ALTER TABLE reaction_roles ADD PRIMARY KEY (message_id, reaction)")
+    )
+
+
+def convert_snowflakes(conn: Connection):
+    for name, columns in SNOWFLAKE_COLUMNS.items():
+        if not _has_table(conn, name):
+            continue
+        types = {c["name"]: c["type"] for c in inspect(conn).get_columns(name)}
+        columns = [c for c in columns if not isinstance(types[c], BigInteger)]
+        if not columns:
+            continue
+        # all columns at once so that the table is rewritten only once
+        conn.execute(
+            text(
+                f"ALTER TABLE {name} "
+                + ", ".join(
+                    f"ALTER COLUMN {c} TYPE BIGINT USING {c}::bigint" for c in columns
+                )
+            )
+        )
+
+
+# version of the schema is the number of applied migrations
+MIGRATIONS = (
+    move_aliases,
+    add_reminder_indexes,
+    add_reaction_role_key,
+    convert_snowflakes,
+)
+
+
+def migrate(conn: Connection):
+    "Creates missing tables and applies migrations that weren't applied yet"
+    fresh = not inspect(conn).get_table_names()
+    metadata.create_all(conn)
+    version = conn.execute(schema_version.select()).scalar()
+    if version is None:
+        # databases from before versioning still need every migration
+        version = len(MIGRATIONS) if fresh else 0
+        conn.execute(schema_version.insert(), {"version": version})
+    for i in range(version, len(MIGRATIONS)):
+        log.info("Migrating schema to version %d...", i + 1)
+        MIGRATIONS[i](conn)
+    if version < len(MIGRATIONS):
+        conn.execute(schema_version.update(), {"version": len(MIGRATIONS)})
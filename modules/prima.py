@@ -1,33 +1,44 @@
 import os
 import ast
 import json
+import time
 import logging as log
 from pydoc import render_doc
 from typing import Iterable
 from threading import Thread
 from types import FunctionType
+from collections import Counter
 from code import InteractiveConsole
 from traceback import format_exception
 from concurrent.futures import Future
 from inspect import isawaitable, iscoroutine, isfunction
 
-import ring
 import aiohttp
 import discord
 from discord import Guild, Message
 from discord.ext import commands
-from sqlalchemy import ARRAY, JSON, Column, String
-from sqlalchemy.ext.asyncio import create_async_engine
+from discord.ext.commands.view import StringView
+from sqlalchemy import ARRAY, JSON, BigInteger, Column, Float, String
+from sqlalchemy.ext.asyncio import AsyncEngine
 
 from . import regexps
-from .db import WrappedTable, metadata
+from .db import WrappedTable, create_engine, flush_all
 from .i18n import t
+from .migrations import migrate
+from .router import MessageRouter
+from .querystats import query_stats
+from .invalidation import InvalidationBus
+from .settings import GuildSettings, GuildSettingsCache, PrefixMatcher
 from .converters import RoleTooHighForUser, RoleTooHighForBot, NotSameGuild
 
 CONFIG_FILE = "config.json"
 DEFAULT_CONFIG = {
     "token": "",
     "db_url": "",
+    # optional replica for reads, writes always go to db_url
+    "db_read_url": "",
+    # seconds after a write during which tables are read from db_url
+    "db_replica_lag": 5.0,
     "activity": {"name": "", "type": 0},
     "status": "online",
     "owner_ids": [],
@@ -35,6 +46,30 @@ DEFAULT_CONFIG = {
     "prefix": ["p1", "P1"],
     "default_language": "en",
     "support_invite": "",
+    # connections kept open, extra ones opened on bursts and how long they live
+    "db_pool_size": 10,
+    "db_max_overflow": 20,
+    "db_pool_recycle": 1800,
+    # check connections before using them
+    "db_pool_pre_ping": False,
+    # prepared statements cached per PostgreSQL connection
+    "db_statement_cache_size": 500,
+    # statements taking longer than this many seconds are logged
+    "slow_query_threshold": 0.1,
+    "guild_cache_size": 10000,
+    # seconds after which cached settings are refreshed in the background
+    "guild_settings_ttl": 300.0,
+    # seconds to wait for settings before using the last known or default ones
+    "guild_settings_deadline": 0.5,
+    "reaction_role_cache_size": 10000,
+    "max_aliases_per_guild": 20,
+    "alias_workers": 4,
+    # seconds of alias matching allowed per message and per guild per period
+    "alias_message_budget": 1.0,
+    "alias_guild_budget": 10.0,
+    "alias_guild_budget_period": 60.0,
+    # new aliases must match long worst-case inputs faster than this
+    "alias_max_match_time": 0.02,
 }
 
 
@@ -42,11 +77,22 @@ MAX_PREFIX_LEN = 100
 guilds_data = WrappedTable(
     "guilds",
     None,
-    Column("guild_id", String(25), primary_key=True),
-    Column("prefixes", ARRAY(String(MAX_PREFIX_LEN))),
-    Column("aliases", JSON),
-    Column("autorole", String(25)),
+    Column("guild_id", BigInteger, primary_key=True),
+    # SQLite has no arrays
+    Column("prefixes", ARRAY(String(MAX_PREFIX_LEN)).with_variant(JSON, "sqlite")),
+    Column("autorole", BigInteger),
     Column("language", String(10)),
+    coalesce=True,
+)
+aliases_data = WrappedTable(
+    "aliases",
+    None,
+    Column("guild_id", BigInteger, primary_key=True),
+    Column("pattern", String, primary_key=True),
+    Column("command", String, nullable=False),
+    # aliases are tried in the order they were added
+    Column("created_at", Float, nullable=False),
+    coalesce=True,
 )
 
 
@@ -112,11 +158,30 @@ class PrimaBot(commands.Bot):
         self.load_config()
 
         self.test_channel_id = self.config["test_channel_id"]
-        self.sql = (
-            create_async_engine(self.config["db_url"]) if self.config["db_url"] else None
-        )
+        # how many messages took each path in on_message
+        self.message_stats = Counter()
+        self.router = MessageRouter()
+        self.sql = self._create_engine(self.config["db_url"])
+        # read-only queries go here, it's the primary if there's no replica
+        self.read_sql = self._create_engine(self.config["db_read_url"]) or self.sql
+        WrappedTable.replica_lag = self.config["db_replica_lag"]
         self.guilds_data = guilds_data
         self.guilds_data.engine = self.sql
+        self.guilds_data.read_engine = self.read_sql
+        self.aliases_data = aliases_data
+        self.aliases_data.engine = self.sql
+        self.aliases_data.read_engine = self.read_sql
+        self.guild_settings = GuildSettingsCache(
+            self.guilds_data,
+            self.aliases_data,
+            self.config["guild_cache_size"],
+            self.config["guild_settings_ttl"],
+            self.config["guild_settings_deadline"],
+        )
+        # other processes drop their copies of changed settings
+        self.invalidation = InvalidationBus(self.sql)
+        self.invalidation.subscribe(self.guilds_data, self.guild_settings.on_write)
+        self.invalidation.subscribe(self.aliases_data, self.guild_settings.on_write)
 
         try:
             activity = discord.Activity(
@@ -129,13 +194,12 @@ class PrimaBot(commands.Bot):
             activity = None
             status = None
 
-        async def prefixes(bot, message):
-            return commands.when_mentioned_or(*(await bot.get_prefixes(message.guild)))(
-                bot, message
-            )
+        async def prefix(bot, message):
+            matcher = await bot.get_prefix_matcher(message.guild)
+            return matcher.match(message.content) or matcher.fallback
 
         super().__init__(
-            prefixes,
+            prefix,
             *args,
             activity=activity,
             status=status,
@@ -143,16 +207,33 @@ class PrimaBot(commands.Bot):
             **kwargs,
         )
 
-    def __ring_key__(self):
-        return f"PrimaBot({self.user.id})"
-
     async def on_ready(self):
+        await self.warm_up_settings()
         log.info("The bot is, like, ready")
         if os.path.isfile("restart"):
             with open("restart") as f:
                 await self._notify_restart(f.read())
             os.remove("restart")
 
+    async def on_guild_join(self, guild: Guild):
+        await self.guild_settings.warm_up((guild.id,))
+
+    async def warm_up_settings(self):
+        log.info("Loading guild settings...")
+        start = time.perf_counter()
+        try:
+            rows = await self.guild_settings.warm_up(g.id for g in self.guilds)
+        except Exception as e:
+            # settings are loaded on demand then
+            log.error("Failed to load guild settings: %s", e)
+            return
+        log.info(
+            "Loaded %d rows of settings for %d guilds in %.2f s.",
+            rows,
+            len(self.guilds),
+            time.perf_counter() - start,
+        )
+
     async def _notify_restart(self, content: str):
         if not content:
             return
@@ -169,10 +250,27 @@ class PrimaBot(commands.Bot):
             log.error("Failed to send restart message: %s", e)
 
     async def on_message(self, message: Message):
+        # loading settings first lets cogs subscribe to a guild seen for the first time
+        await self.get_guild_settings(message.guild)
+        for handler in self.router.get_handlers(message):
+            self._schedule_event(handler, "on_message", message)
+
         if self.test_mode != (message.channel.id == self.test_channel_id):
             return
 
         if message.author.bot:
+            self.message_stats["bot"] += 1
+            return
+
+        # most messages are neither commands nor pings, reject them early
+        pinged = regexps.PING.fullmatch(message.content)
+        pinged = pinged is not None and pinged.group("id") == str(self.user.id)
+        if pinged:
+            self.message_stats["ping"] += 1
+        elif (await self.get_prefix_matcher(message.guild)).match(message.content):
+            self.message_stats["command"] += 1
+        else:
+            self.message_stats["ignored"] += 1
             return
 
         ctx = await self.get_context(message, cls=PrimaContext)
@@ -183,8 +281,7 @@ class PrimaBot(commands.Bot):
         else:
             add_zipper = ctx.command is not None
 
-        pinged = regexps.PING.fullmatch(message.content)
-        if pinged and pinged.group("id") == str(self.user.id):
+        if pinged:
             if perms.send_messages:
                 await message.channel.send(
                     await self.get_prefixes_string(message.guild)
@@ -223,11 +320,26 @@ class PrimaBot(commands.Bot):
             return super().run(token)
         log.fatal("Please enter the token in %s", CONFIG_FILE)
 
+    def _create_engine(self, url: str) -> AsyncEngine | None:
+        if not url:
+            return None
+        engine = create_engine(
+            url,
+            self.config["db_statement_cache_size"],
+            pool_size=self.config["db_pool_size"],
+            max_overflow=self.config["db_max_overflow"],
+            pool_recycle=self.config["db_pool_recycle"],
+            pool_pre_ping=self.config["db_pool_pre_ping"],
+        )
+        query_stats.watch(engine, self.config["slow_query_threshold"])
+        return engine
+
     async def start(self, token):
         self.session = aiohttp.ClientSession()
 
         async with self.sql.begin() as conn:
-            await conn.run_sync(metadata.create_all)
+            await conn.run_sync(migrate)
+        await self.invalidation.start()
 
         if self.test_mode:
             start_console(self)
@@ -235,6 +347,8 @@ class PrimaBot(commands.Bot):
         await super().start(token)
 
     async def close(self):
+        await flush_all()
+        await self.invalidation.stop()
         await self.session.close()
         await super().close()
 
@@ -245,6 +359,23 @@ class PrimaBot(commands.Bot):
         ctx.language = await self.get_language(message.guild)
         return ctx
 
+    def build_context(
+        self, message: Message, prefix: str, invoker: str, language: str
+    ) -> "PrimaContext":
+        "Builds context for a message whose prefix, command and language are known"
+        view = StringView(message.content)
+        view.skip_string(prefix + invoker)
+        ctx = PrimaContext(
+            prefix=prefix,
+            view=view,
+            bot=self,
+            message=message,
+            invoked_with=invoker,
+            command=self.prefixed_commands.get(invoker),
+        )
+        ctx.language = language
+        return ctx
+
     async def get_application_context(self, interaction, *, cls=None):
         kwargs = {}
         if cls is not None:
@@ -253,25 +384,25 @@ class PrimaBot(commands.Bot):
         ctx.language = await self.get_language(interaction.guild)
         return ctx
 
+    async def get_guild_settings(self, guild: Guild | None) -> GuildSettings:
+        return await self.guild_settings.get(guild)
+
     async def get_guild_property(self, guild: Guild, prop: str):
-        res = await self.guilds_data.select(prop, guild_id=str(guild.id))
-        if res:
-            return res[0][0]
-        return None
-
-    @ring.lru(force_asyncio=True)
-    async def get_prefixes(self, guild: Guild | None, use_default=True):
-        if guild:
-            return (await self.get_guild_property(guild, "prefixes")) or (
-                self.config["prefix"] if use_default else []
-            )
-        return self.config["prefix"]
+        return getattr(await self.get_guild_settings(guild), prop)
+
+    async def get_prefixes(self, guild: Guild | None, use_default=True) -> list[str]:
+        if guild is None:
+            return self.config["prefix"]
+        prefixes = (await self.get_guild_settings(guild)).prefixes
+        return prefixes or (self.config["prefix"] if use_default else [])
+
+    async def get_prefix_matcher(self, guild: Guild | None) -> PrefixMatcher:
+        return (await self.get_guild_settings(guild)).prefix_matcher(
+            self.config["prefix"], self.user.id
+        )
 
-    @ring.lru(force_asyncio=True)
-    async def get_aliases(self, guild: Guild | None):
-        if guild:
-            return (await self.get_guild_property(guild, "aliases")) or {}
-        return {}
+    async def get_aliases(self, guild: Guild | None) -> dict[str, str]:
+        return (await self.get_guild_settings(guild)).aliases or {}
 
     async def get_prefixes_string(self, guild: Guild | None):
         return t(
@@ -281,19 +412,16 @@ class PrimaBot(commands.Bot):
             prefixes="\n".join(await self.get_prefixes(guild)),
         )
 
-    @ring.lru(force_asyncio=True)
-    async def get_language(self, guild: Guild | None):
-        if guild:
-            return (await self.get_guild_property(guild, "language")) or self.config[
-                "default_language"
-            ]
-        return self.config["default_language"]
+    async def get_language(self, guild: Guild | None) -> str:
+        return (await self.get_guild_settings(guild)).language or self.config[
+            "default_language"
+        ]
 
     def load_config(self):
         log.info("Loading configuration...")
         if os.path.isfile(CONFIG_FILE):
             with open(CONFIG_FILE) as f:
-                self.config = json.load(f)
+                self.config = DEFAULT_CONFIG | json.load(f)
         else:
             self.config = DEFAULT_CONFIG
             self.save_config()
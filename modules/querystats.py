@@ -0,0 +1,114 @@
+import logging as log
+from time import perf_counter
+from collections import deque
+from statistics import quantiles
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+# durations kept for percentiles of each table and operation
+SAMPLES = 1000
+
+
+def _describe(context, statement: str) -> tuple[str, str]:
+    "Returns table and operation of executed statement"
+    compiled = getattr(context, "compiled", None)
+    clause = getattr(compiled, "statement", None)
+    if clause is not None and clause.is_select:
+        froms = clause.get_final_froms()
+        return getattr(froms[0], "name", "?") if froms else "", "select"
+    if clause is not None and clause.is_dml:
+        return clause.table.name, clause.__visit_name__
+    # text and DDL
+    words = statement.split(None, 1)
+    return "", words[0].lower() if words else ""
+
+
+def _shape(parameters) -> str:
+    "Describes parameters without their values"
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            return f"{len(parameters)} x {_shape(parameters[0])}"
+        return "(" + ", ".join(type(p).__name__ for p in parameters) + ")"
+    if isinstance(parameters, dict):
+        return (
+            "{"
+            + ", ".join(
+                f"{k}: {type(v).__name__}"
+                + (f"[{len(v)}]" if isinstance(v, (list, tuple)) else "")
+                for k, v in parameters.items()
+            )
+            + "}"
+        )
+    return type(parameters).__name__
+
+
+class QueryStats:
+    "Times statements executed by engines and logs slow ones"
+
+    def __init__(self):
+        self.threshold = 0.0
+        # (table, operation) -> [count, total time, recent durations]
+        self.stats: dict[tuple[str, str], list] = {}
+
+    def watch(self, engine: AsyncEngine, threshold: float):
+        "Statements taking longer than threshold seconds are logged"
+        self.threshold = threshold
+        event.listen(engine.sync_engine, "before_cursor_execute", self._before)
+        event.listen(engine.sync_engine, "after_cursor_execute", self._after)
+        event.listen(engine.sync_engine, "handle_error", self._error)
+
+    @staticmethod
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        # after_cursor_execute isn't called for statements that fail,
+        # so nothing may be left behind on the connection
+        context._query_start = perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        self._record(context, statement, parameters)
+
+    def _error(self, exception_context):
+        context = exception_context.execution_context
+        # errors before a statement was sent, e.g. of connecting, aren't timed
+        if context is not None and hasattr(context, "_query_start"):
+            self._record(
+                context, exception_context.statement, exception_context.parameters
+            )
+
+    def _record(self, context, statement: str, parameters):
+        elapsed = perf_counter() - context._query_start
+        key = _describe(context, statement)
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = [0, 0.0, deque(maxlen=SAMPLES)]
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2].append(elapsed)
+        if elapsed > self.threshold:
+            log.warning(
+                "Slow %s on %s took %.3f s, parameters: %s",
+                key[1],
+                key[0] or "?",
+                elapsed,
+                _shape(parameters),
+            )
+
+    def describe(self) -> list[str]:
+        lines = []
+        for (table, operation), (count, total, durations) in sorted(
+            self.stats.items(), key=lambda item: -item[1][1]
+        ):
+            if len(durations) > 1:
+                percentiles = quantiles(durations, n=100)
+                p50, p95, p99 = percentiles[49], percentiles[94], percentiles[98]
+            else:
+                p50 = p95 = p99 = durations[0]
+            lines.append(
+                f"{table or '?'} {operation}: {count}, total {total:.2f} s,"
+                f" p50 {p50 * 1000:.1f} ms, p95 {p95 * 1000:.1f} ms,"
+                f" p99 {p99 * 1000:.1f} ms"
+            )
+        return lines
+
+
+query_stats = QueryStats()
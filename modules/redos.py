@@ -0,0 +1,157 @@
+"""
+Estimates worst-case matching time of regular expressions.
+Static analysis finds quantifiers that can backtrack a lot
+and then matching is timed against inputs built to trigger it.
+The analysis uses the private parser of the standard library, as it's the only
+available parser of pattern structure. If that parser is missing or changed,
+only generic inputs are tried.
+"""
+
+from math import inf
+from time import monotonic
+from typing import Iterable
+
+import regex
+
+try:
+    from re import _parser, _constants as c
+
+    REPEATS = (c.MAX_REPEAT, c.MIN_REPEAT, c.POSSESSIVE_REPEAT)
+    CATEGORY_EXAMPLES = {
+        c.CATEGORY_DIGIT: "0",
+        c.CATEGORY_NOT_DIGIT: "a",
+        c.CATEGORY_SPACE: " ",
+        c.CATEGORY_NOT_SPACE: "a",
+        c.CATEGORY_WORD: "a",
+        c.CATEGORY_NOT_WORD: " ",
+    }
+except (ImportError, AttributeError):
+    _parser = None
+
+MAX_INPUT_LENGTH = 2000
+# generic inputs for patterns where analysis finds nothing or fails
+GENERIC_PUMPS = ("a", " ", "a ", '"', '"a', "\\")
+# what follows a pump to make the match fail at the very end
+SUFFIXES = ("", "!", " ", "\n")
+
+
+def _example(items: Iterable) -> str:
+    "Returns a string that the sequence of parsed items is likely to match"
+    result = []
+    for op, av in items:
+        if op is c.LITERAL:
+            result.append(chr(av))
+        elif op is c.NOT_LITERAL:
+            result.append("b" if av == ord("a") else "a")
+        elif op is c.ANY:
+            result.append("a")
+        elif op is c.IN:
+            result.append(_example_in(av))
+        elif op is c.CATEGORY:
+            result.append(CATEGORY_EXAMPLES.get(av, "a"))
+        elif op in REPEATS:
+            min_count, _, body = av
+            result.append(_example(body) * max(min_count, 1))
+        elif op is c.SUBPATTERN:
+            result.append(_example(av[-1]))
+        elif op is c.ATOMIC_GROUP:
+            result.append(_example(av))
+        elif op is c.BRANCH:
+            result.append(_example(av[1][0]))
+    return "".join(result)
+
+
+def _example_in(items: list) -> str:
+    if items and items[0][0] is c.NEGATE:
+        # anything that isn't listed explicitly
+        listed = {chr(av) for op, av in items if op is c.LITERAL}
+        return next((ch for ch in "a0 !" if ch not in listed), "\0")
+    op, av = items[0]
+    if op is c.RANGE:
+        return chr(av[0])
+    if op is c.CATEGORY:
+        return CATEGORY_EXAMPLES.get(av, "a")
+    return chr(av)
+
+
+def _can_repeat(op, av) -> bool:
+    return op in REPEATS and av[1] > 1
+
+
+def _is_ambiguous(items: Iterable) -> bool:
+    "Checks whether repeated items contain another repeat or an alternation"
+    for op, av in items:
+        if _can_repeat(op, av) or op is c.BRANCH:
+            return True
+        if op in REPEATS and _is_ambiguous(av[2]):
+            return True
+        if op is c.SUBPATTERN and _is_ambiguous(av[-1]):
+            return True
+        if op is c.ATOMIC_GROUP and _is_ambiguous(av):
+            return True
+    return False
+
+
+def find_pumps(items: list, prefix: str = "") -> list[tuple[str, str]]:
+    """
+    Finds nested quantifiers, quantified alternations and adjacent quantifiers.
+    Returns (prefix, pump) pairs, where prefix leads to the quantifier
+    and pump is what it repeats.
+    """
+    found = []
+    items = list(items)
+    for i, (op, av) in enumerate(items):
+        here = prefix + _example(items[:i])
+        if op in REPEATS:
+            body = av[2]
+            if _can_repeat(op, av) and _is_ambiguous(body):
+                found.append((here, _example(body)))
+            elif (
+                _can_repeat(op, av) and i + 1 < len(items) and _can_repeat(*items[i + 1])
+            ):
+                found.append((here, _example(body)))
+            found.extend(find_pumps(body, here))
+        elif op is c.SUBPATTERN:
+            found.extend(find_pumps(av[-1], here))
+        elif op is c.BRANCH:
+            for branch in av[1]:
+                found.extend(find_pumps(branch, here))
+    return found
+
+
+def trial_inputs(source: str, flags: int, prefixes: Iterable[str] = ()) -> set[str]:
+    "Builds inputs that are likely to make the pattern backtrack"
+    pumps = [(prefix, pump) for pump in GENERIC_PUMPS for prefix in ("", *prefixes)]
+    if _parser is not None:
+        try:
+            pumps.extend(find_pumps(_parser.parse(source, flags)))
+        except Exception:
+            # syntax specific to the regex module, rely on generic inputs
+            pass
+    inputs = set()
+    for prefix, pump in pumps:
+        if not pump:
+            continue
+        for suffix in SUFFIXES:
+            count = (MAX_INPUT_LENGTH - len(prefix) - len(suffix)) // len(pump)
+            inputs.add(prefix + pump * count + suffix)
+    return inputs
+
+
+def worst_case_time(
+    pattern: regex.Pattern, timeout: float, prefixes: Iterable[str] = ()
+) -> float:
+    """
+    Returns the longest time matching a trial input took,
+    or infinity if some match didn't finish within the timeout.
+    """
+    flags = pattern.flags & (regex.I | regex.S)
+    worst = 0.0
+    for text in trial_inputs(pattern.pattern, flags, prefixes):
+        start = monotonic()
+        try:
+            pattern.fullmatch(text, timeout=timeout)
+        except TimeoutError:
+            return inf
+        worst = max(worst, monotonic() - start)
+    return worst
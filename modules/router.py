@@ -0,0 +1,66 @@
+from typing import Any, Callable, Coroutine
+
+from discord import Message
+
+Handler = Callable[[Message], Coroutine[Any, Any, Any]]
+
+
+class MessageRouter:
+    """
+    Keeps track of which handlers are interested in which guilds and channels,
+    so that a message is passed only to handlers that have something to do.
+    """
+
+    def __init__(self):
+        self._guilds: dict[int, set[Handler]] = {}
+        self._channels: dict[int, set[Handler]] = {}
+
+    @staticmethod
+    def _add(subscriptions: dict[int, set[Handler]], key: int, handler: Handler):
+        subscriptions.setdefault(key, set()).add(handler)
+
+    @staticmethod
+    def _discard(subscriptions: dict[int, set[Handler]], key: int, handler: Handler):
+        handlers = subscriptions.get(key)
+        if handlers is None:
+            return
+        handlers.discard(handler)
+        if not handlers:
+            del subscriptions[key]
+
+    def subscribe(
+        self,
+        handler: Handler,
+        *,
+        guild_id: int | None = None,
+        channel_id: int | None = None,
+    ):
+        if guild_id is not None:
+            self._add(self._guilds, guild_id, handler)
+        if channel_id is not None:
+            self._add(self._channels, channel_id, handler)
+
+    def unsubscribe(
+        self,
+        handler: Handler,
+        *,
+        guild_id: int | None = None,
+        channel_id: int | None = None,
+    ):
+        if guild_id is not None:
+            self._discard(self._guilds, guild_id, handler)
+        if channel_id is not None:
+            self._discard(self._channels, channel_id, handler)
+
+    def remove(self, handler: Handler):
+        "Removes all subscriptions of the handler"
+        for subscriptions in (self._guilds, self._channels):
+            for key in [k for k, v in subscriptions.items() if handler in v]:
+                self._discard(subscriptions, key, handler)
+
+    def get_handlers(self, message: Message) -> set[Handler]:
+        handlers = self._channels.get(message.channel.id)
+        guild_handlers = message.guild and self._guilds.get(message.guild.id)
+        if handlers and guild_handlers:
+            return handlers | guild_handlers
+        return handlers or guild_handlers or set()
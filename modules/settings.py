@@ -0,0 +1,222 @@
+import re
+import asyncio
+import logging as log
+from math import inf
+from time import monotonic
+from typing import Any, Callable, Iterable
+
+from discord import Guild
+
+from .db import MULTIPLE_VALUES, WrappedTable
+from .cache import LRUCache
+from .aliases import AliasIndex
+from .utils import chunks
+
+WARM_UP_BATCH_SIZE = 1000
+
+
+class PrefixMatcher:
+    "Finds which of the prefixes or bot mentions a message starts with"
+
+    __slots__ = ("_pattern", "fallback")
+
+    def __init__(self, prefixes: Iterable[str], user_id: int):
+        mentions = (f"<@{user_id}> ", f"<@!{user_id}> ")
+        # prefix that can't be at the start of a message which didn't match
+        self.fallback = mentions[0]
+        # the longest prefix wins, like with sorted list of prefixes
+        self._pattern = re.compile(
+            "|".join(
+                map(re.escape, sorted({*mentions, *prefixes}, key=len, reverse=True))
+            )
+        )
+
+    def match(self, content: str) -> str | None:
+        match = self._pattern.match(content)
+        return match and match.group()
+
+
+class GuildSettings:
+    "Row of the guilds table with aliases of the guild, empty if guild has no row"
+
+    COLUMNS = ("prefixes", "autorole", "language")
+    __slots__ = COLUMNS + ("aliases", "loaded_at", "_prefix_matcher", "_alias_index")
+
+    def __init__(self, prefixes=None, autorole=None, language=None, aliases=None):
+        self.prefixes: list[str] | None = prefixes
+        self.autorole: int | None = autorole
+        self.language: str | None = language
+        self.aliases: dict[str, str] | None = aliases
+        self.loaded_at = -inf
+        self._prefix_matcher: PrefixMatcher | None = None
+        self._alias_index: AliasIndex | None = None
+
+    def prefix_matcher(self, default_prefixes: list[str], user_id: int) -> PrefixMatcher:
+        "Matcher is built on first use and lives as long as the settings"
+        if self._prefix_matcher is None:
+            self._prefix_matcher = PrefixMatcher(
+                self.prefixes or default_prefixes, user_id
+            )
+        return self._prefix_matcher
+
+    def alias_index(self) -> AliasIndex:
+        if self._alias_index is None:
+            self._alias_index = AliasIndex(self.aliases or {})
+        return self._alias_index
+
+
+class GuildSettingsCache:
+    """
+    Size-bounded cache of GuildSettings loaded from the guilds and aliases tables.
+    Entries are dropped whenever the tables are written to.
+    Entries older than ttl are served while being refreshed in the background.
+    Loads that take longer than deadline give the last known settings
+    or empty ones, so that the database being slow doesn't stall commands.
+    """
+
+    def __init__(
+        self,
+        table: WrappedTable,
+        aliases_table: WrappedTable,
+        maxsize: int,
+        ttl: float = inf,
+        deadline: float = inf,
+    ):
+        self.table = table
+        self.aliases_table = aliases_table
+        self.ttl = ttl
+        self.deadline = deadline
+        self._cache: LRUCache[int, GuildSettings] = LRUCache(maxsize)
+        # dropped entries, used only if loading takes too long
+        self._previous: LRUCache[int, GuildSettings] = LRUCache(maxsize)
+        self._loading: dict[int, asyncio.Task] = {}
+        # changes on every invalidation so that loads racing with a write
+        # don't put outdated settings into the cache
+        self._generation = 0
+        self._empty = GuildSettings()
+        # called with guild id and settings whenever they're put into the cache
+        self.load_listeners: list[Callable[[int, GuildSettings], Any]] = []
+        table.watchers.append(self.on_write)
+        aliases_table.watchers.append(self.on_write)
+
+    def _store(self, guild_id: int, settings: GuildSettings):
+        settings.loaded_at = monotonic()
+        self._cache[guild_id] = settings
+        self._previous.pop(guild_id)
+        for listener in self.load_listeners:
+            listener(guild_id, settings)
+
+    def items(self) -> Iterable[tuple[int, GuildSettings]]:
+        return self._cache.items()
+
+    def on_write(self, values: dict):
+        self._generation += 1
+        guild_id = values.get("guild_id")
+        if guild_id is None:
+            guild_ids = [i for i, _ in self._cache.items()]
+            self._loading.clear()
+        elif isinstance(guild_id, MULTIPLE_VALUES):
+            guild_ids = guild_id
+        else:
+            guild_ids = (guild_id,)
+        for i in guild_ids:
+            # loads that started before the write are left to finish unseen
+            self._loading.pop(i, None)
+            settings = self._cache.pop(i)
+            if settings is not None:
+                self._previous[i] = settings
+
+    async def _load(
+        self, guild_ids: list[int], primary: bool = False
+    ) -> tuple[dict[int, GuildSettings], int]:
+        "Returns settings of guilds that have any and number of fetched rows"
+        table_select = self.table.select_primary if primary else self.table.select
+        aliases_select = (
+            self.aliases_table.select_primary if primary else self.aliases_table.select
+        )
+        rows = await table_select("guild_id", *GuildSettings.COLUMNS, guild_id=guild_ids)
+        alias_rows = await aliases_select(
+            "guild_id", "pattern", "command", "created_at", guild_id=guild_ids
+        )
+        loaded = {guild_id: GuildSettings(*row) for guild_id, *row in rows}
+        # aliases are tried in the order they were added
+        alias_rows.sort(key=lambda row: row[3])
+        for guild_id, pattern, command, _ in alias_rows:
+            settings = loaded.setdefault(guild_id, GuildSettings())
+            if settings.aliases is None:
+                settings.aliases = {}
+            settings.aliases[pattern] = command
+        return loaded, len(rows) + len(alias_rows)
+
+    async def _refresh(self, guild_id: int) -> GuildSettings | None:
+        generation = self._generation
+        try:
+            loaded, _ = await self._load([guild_id])
+        except Exception as e:
+            log.error("Failed to load settings of guild %d: %s", guild_id, e)
+            return None
+        finally:
+            if self._loading.get(guild_id) is asyncio.current_task():
+                del self._loading[guild_id]
+        # guilds without a row are cached too
+        settings = loaded.get(guild_id) or GuildSettings()
+        if generation == self._generation:
+            self._store(guild_id, settings)
+        return settings
+
+    def _start_refresh(self, guild_id: int) -> asyncio.Task:
+        "Loads settings once no matter how many are waiting for them"
+        task = self._loading.get(guild_id)
+        if task is None:
+            task = self._loading[guild_id] = asyncio.ensure_future(
+                self._refresh(guild_id)
+            )
+        return task
+
+    async def get(self, guild: Guild | None) -> GuildSettings:
+        if guild is None:
+            return self._empty
+        settings = self._cache.get(guild.id)
+        if settings is not None:
+            if monotonic() - settings.loaded_at > self.ttl:
+                self._start_refresh(guild.id)
+            return settings
+        task = self._start_refresh(guild.id)
+        try:
+            # waiting is cancelled on timeout but loading goes on
+            settings = await asyncio.wait_for(asyncio.shield(task), self.deadline)
+        except asyncio.TimeoutError:
+            log.warning("Loading settings of guild %d is taking too long", guild.id)
+            settings = None
+        return settings or self._previous.get(guild.id) or self._empty
+
+    async def load(self, guild: Guild) -> GuildSettings:
+        """
+        Reads settings from the primary however long it takes.
+        Commands that change settings based on current ones must use this
+        rather than get, which may give the last known or empty settings.
+        """
+        generation = self._generation
+        loaded, _ = await self._load([guild.id], primary=True)
+        settings = loaded.get(guild.id) or GuildSettings()
+        if generation == self._generation:
+            self._store(guild.id, settings)
+        return settings
+
+    async def warm_up(self, guild_ids: Iterable[int]) -> int:
+        """
+        Loads settings of many guilds that aren't cached with batched queries.
+        Returns number of fetched rows.
+        """
+        # there's no point in loading more than the cache can hold
+        guild_ids = [i for i in guild_ids if i not in self._cache][: self._cache.maxsize]
+        total = 0
+        for batch in chunks(guild_ids, WARM_UP_BATCH_SIZE):
+            generation = self._generation
+            loaded, rows = await self._load(batch)
+            total += rows
+            if generation != self._generation:
+                continue
+            for guild_id in batch:
+                self._store(guild_id, loaded.get(guild_id) or GuildSettings())
+        return total
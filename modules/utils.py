@@ -4,7 +4,7 @@ from types import FunctionType
 from inspect import iscoroutine
 from traceback import print_exc
 from contextlib import redirect_stdout
-from typing import Any, Iterable, Sequence, TypeVar
+from typing import Any, AsyncIterable, AsyncIterator, Iterable, Sequence, TypeVar
 
 T = TypeVar("T")
 
@@ -26,3 +26,14 @@ async def execute(code: str, globals: dict[str, Any] = {}) -> str:
 def chunks(lst: Sequence[T], n: int) -> Iterable[Sequence[T]]:
     for i in range(0, len(lst), n):
         yield lst[i : i + n]  # noqa: E203
+
+
+async def achunks(iterable: AsyncIterable[T], n: int) -> AsyncIterator[list[T]]:
+    chunk = []
+    async for item in iterable:
+        chunk.append(item)
+        if len(chunk) == n:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk